@@ -0,0 +1,63 @@
+# _conftest.py -- provides the configuration file for the test sessions that get
+# run and timed by the benchmarks in `bench_fixtures.py`
+import os
+
+import pytest
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+
+DB_CONN = os.environ['BENCHMARK_DATABASE_URL']
+
+pytest_plugins = ['pytest-flask-sqlalchemy']
+
+
+@pytest.fixture(scope='session')
+def app():
+    '''
+    Create a Flask app context for the tests.
+    '''
+    app = Flask(__name__)
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = DB_CONN
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+    return app
+
+
+@pytest.fixture(scope='session')
+def _db(app):
+    '''
+    Provide the transactional fixtures with access to the database.
+    '''
+    db = SQLAlchemy(app=app)
+    return db
+
+
+@pytest.fixture(scope='session')
+def item(_db):
+    '''
+    Create a table for the tests to read and write.
+    '''
+    class Item(_db.Model):
+        __tablename__ = 'benchmark_item'
+        id = _db.Column(_db.Integer, primary_key=True)
+        name = _db.Column(_db.String(80))
+
+    _db.create_all()
+
+    return Item
+
+
+@pytest.fixture
+def bare_connection(_db):
+    '''
+    Wrap the test in a transaction without any of the plugin's fixtures, as a
+    baseline for the cost of the plugin.
+    '''
+    connection = _db.engine.connect()
+    transaction = connection.begin()
+
+    yield connection
+
+    transaction.rollback()
+    connection.close()
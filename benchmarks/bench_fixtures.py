@@ -0,0 +1,168 @@
+'''
+Benchmarks for the overhead that the transactional fixtures add to each test.
+
+Each benchmark times a complete pytest session of `TESTS` tests, so comparing the
+results within a group shows the cost per test of the plugin's fixtures and
+options. Run them with:
+
+    pytest benchmarks
+'''
+import json
+
+import pytest
+
+TESTS = 50
+
+TEST_FILE = """
+import pytest
+import sqlalchemy as sa
+
+@pytest.mark.parametrize('run', range({tests}))
+def test_overhead({fixtures}, run):
+{body}
+"""
+
+
+def run_session(bench_testdir, benchmark, fixtures, body, tests=TESTS):
+    '''
+    Time a pytest session running `tests` tests that use `fixtures` and run `body`.
+    '''
+    bench_testdir.makepyfile(test_overhead=TEST_FILE.format(tests=tests,
+                                                            fixtures=', '.join(fixtures),
+                                                            body=body))
+
+    def run():
+        return bench_testdir.runpytest_inprocess('-q', '-p', 'no:cacheprovider')
+
+    benchmark.extra_info['tests'] = tests
+    result = benchmark.pedantic(run, rounds=5, warmup_rounds=1)
+    result.assert_outcomes(passed=tests)
+
+
+@pytest.mark.parametrize('fixture', ['bare_connection', 'db_session', 'db_engine',
+                                     'db_session_readonly'])
+def bench_fixture_overhead(bench_testdir, benchmark, fixture):
+    '''
+    Compare the transactional fixtures to a test using a bare connection.
+    '''
+    benchmark.group = 'fixtures'
+    run_session(bench_testdir, benchmark, [fixture],
+                "    {}.execute(sa.text('SELECT 1'))".format(fixture))
+
+
+@pytest.mark.parametrize('reuse_connection', ['false', 'true'])
+def bench_reuse_connection(bench_testdir, benchmark, reuse_connection):
+    '''
+    Compare opening a connection for every test to reusing one for the session.
+    '''
+    benchmark.group = 'reuse-connection'
+    bench_testdir.makeini("""
+        [pytest]
+        reuse-connection={}
+    """.format(reuse_connection))
+
+    run_session(bench_testdir, benchmark, ['db_session'],
+                "    db_session.execute(sa.text('SELECT 1'))")
+
+
+@pytest.mark.parametrize('uses_database', [False, True])
+def bench_lazy_connection(bench_testdir, benchmark, uses_database):
+    '''
+    Compare tests that request `db_session` without running any SQL to tests
+    that do, which are the only ones that open a connection.
+    '''
+    benchmark.group = 'lazy-connection'
+    body = "    db_session.execute(sa.text('SELECT 1'))" if uses_database else '    pass'
+    run_session(bench_testdir, benchmark, ['db_session'], body)
+
+
+@pytest.mark.parametrize('paths', [0, 10, 50])
+def bench_mocked_paths(bench_testdir, benchmark, paths):
+    '''
+    Measure how the cost of patching scales with the number of mocked paths.
+    '''
+    benchmark.group = 'mocked-paths'
+    bench_testdir.makepyfile(mocked_targets='\n'.join(
+        'engine_{0} = session_{0} = sessionmaker_{0} = None'.format(index)
+        for index in range(paths)
+    ))
+    bench_testdir.makeini("""
+        [pytest]
+        mocked-engines={}
+        mocked-sessions={}
+        mocked-sessionmakers={}
+    """.format(*(' '.join('mocked_targets.{}_{}'.format(name, index) for index in range(paths))
+                 for name in ('engine', 'session', 'sessionmaker'))))
+
+    run_session(bench_testdir, benchmark, ['db_session', 'db_engine'],
+                "    db_session.execute(sa.text('SELECT 1'))")
+
+
+@pytest.mark.parametrize('objects', [10, 1000])
+def bench_identity_map(bench_testdir, benchmark, objects):
+    '''
+    Measure the cost of committing and reading back a session holding many objects.
+    '''
+    benchmark.group = 'identity-map'
+    run_session(bench_testdir, benchmark, ['item', 'db_session'], """
+    items = [item(name='item') for _ in range({})]
+    db_session.add_all(items)
+    db_session.commit()
+    assert all(instance.name == 'item' for instance in items)
+""".format(objects), tests=10)
+
+
+@pytest.mark.parametrize('commits', [1, 50])
+def bench_savepoint_churn(bench_testdir, benchmark, commits):
+    '''
+    Measure the cost of restarting the test's savepoint each time the code under
+    test commits.
+    '''
+    benchmark.group = 'savepoint-churn'
+    run_session(bench_testdir, benchmark, ['item', 'db_session'], """
+    for _ in range({}):
+        db_session.add(item(name='item'))
+        db_session.commit()
+""".format(commits), tests=10)
+
+
+@pytest.mark.parametrize('fixture,raw_connection', [
+    ('bare_connection', 'bare_connection.connection'),
+    ('db_engine', 'db_engine.raw_connection()'),
+])
+def bench_raw_bulk_load(bench_testdir, benchmark, fixture, raw_connection):
+    '''
+    Compare loading rows with `executemany()` through the raw connection that
+    `db_engine` hands out to loading them through a bare DBAPI connection.
+    '''
+    benchmark.group = 'raw-bulk-load'
+    run_session(bench_testdir, benchmark, ['item', fixture], """
+    marker = '?' if {fixture}.dialect.paramstyle == 'qmark' else '%s'
+    cursor = {raw_connection}.cursor()
+    cursor.executemany('INSERT INTO benchmark_item (name) VALUES ({{}})'.format(marker),
+                       [('item',)] * 10000)
+""".format(fixture=fixture, raw_connection=raw_connection), tests=10)
+
+
+@pytest.mark.parametrize('loader', ['db_session', 'db_seed'])
+def bench_seed_data(bench_testdir, benchmark, loader):
+    '''
+    Compare loading seed data by adding objects to `db_session` one at a time to
+    loading it from a seed file with `db_seed`.
+    '''
+    benchmark.group = 'seed-data'
+    bench_testdir.makefile('.json', items=json.dumps({
+        'benchmark_item': [{'name': 'item'} for _ in range(1000)],
+    }))
+
+    bodies = {
+        'db_session': """
+    for _ in range(1000):
+        db_session.add(item(name='item'))
+    db_session.commit()
+""",
+        'db_seed': """
+    db_seed('items.json')
+""",
+    }
+    run_session(bench_testdir, benchmark, ['item', loader], bodies[loader], tests=10)
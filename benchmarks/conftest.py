@@ -0,0 +1,56 @@
+import os
+
+import pytest
+import sqlalchemy as sa
+
+# Import Flask-SQLAlchemy up front for the same reason as in `tests/conftest.py`,
+# since the benchmarks load it again in each in-process test session
+from flask_sqlalchemy import SQLAlchemy
+
+from pytest_flask_sqlalchemy import databases
+
+pytest_plugins = ['pytester']
+
+
+@pytest.fixture(scope='session', params=['sqlite-memory', 'sqlite', 'postgresql'])
+def database_url(request, tmp_path_factory):
+    '''
+    Run each benchmark against in-memory and on-disk SQLite databases, and
+    against Postgres if a connection string for it is available.
+    '''
+    if request.param == 'sqlite-memory':
+        yield 'sqlite://'
+        return
+
+    if request.param == 'sqlite':
+        yield 'sqlite:///' + str(tmp_path_factory.mktemp('benchmarks') / 'benchmarks.db')
+        return
+
+    url = os.environ.get('BENCHMARK_POSTGRES_URL', os.environ.get('TEST_DATABASE_URL'))
+    if not url:
+        pytest.skip('Export a Postgres connection string to BENCHMARK_POSTGRES_URL ' +
+                    'or TEST_DATABASE_URL to run the benchmarks against Postgres.')
+
+    parsed_url = sa.engine.url.make_url(url)
+    created = not databases.database_exists(parsed_url)
+    if created:
+        databases.create_database(parsed_url)
+
+    yield url
+
+    if created:
+        databases.drop_database(parsed_url)
+
+
+@pytest.fixture
+def bench_testdir(testdir, monkeypatch, database_url):
+    '''
+    Set up a temporary test directory loaded with the configuration file for the
+    test sessions that the benchmarks run.
+    '''
+    with open(os.path.join(os.path.dirname(__file__), '_conftest.py')) as conf:
+        testdir.makeconftest(conf.read())
+
+    monkeypatch.setenv('BENCHMARK_DATABASE_URL', database_url)
+
+    return testdir
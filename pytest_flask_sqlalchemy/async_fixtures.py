@@ -0,0 +1,251 @@
+import contextlib
+
+import pytest
+import pytest_asyncio
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import dialects, profiling
+from .patching import install_targets
+from .sessions import JOIN_EXTERNAL_TRANSACTIONS
+
+
+class _AsyncConnectionContext(object):
+    '''
+    Stand in for the result of `AsyncEngine.connect()`, which can either be
+    awaited or used as an async context manager, without closing the test's
+    connection on the way out.
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def _connect(self):
+        return self.connection
+
+    def __await__(self):
+        return self._connect().__await__()
+
+    async def __aenter__(self):
+        return self.connection
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class AsyncTransactionalEngine(object):
+    '''
+    A stand-in for a SQLAlchemy AsyncEngine that redirects all database access
+    to the AsyncConnection of the test that is currently running.
+    '''
+    def __init__(self, connection=None):
+        self.connection = connection
+
+    def __repr__(self):
+        return '<AsyncTransactionalEngine connection={!r}>'.format(self.connection)
+
+    @property
+    def dialect(self):
+        return self.connection.dialect
+
+    @property
+    def url(self):
+        return self.connection.engine.url
+
+    @property
+    def name(self):
+        return self.connection.engine.name
+
+    @property
+    def driver(self):
+        return self.connection.engine.driver
+
+    def connect(self):
+        '''
+        Return a reference to the open connection.
+        '''
+        return _AsyncConnectionContext(self.connection)
+
+    @contextlib.asynccontextmanager
+    async def begin(self):
+        '''
+        Open a new nested transaction on the connection.
+        '''
+        async with self.connection.begin_nested():
+            yield self.connection
+
+
+@pytest.fixture(scope='module')
+def _async_db():
+    '''
+    A user-defined _async_db fixture is required to provide the async fixtures
+    with a SQLAlchemy AsyncEngine that can access the test database. If the user
+    hasn't defined that fixture, raise an error.
+    '''
+    msg = ("_async_db fixture not defined. The async fixtures of the " +
+           "pytest-flask-sqlalchemy plugin require you to define an _async_db " +
+           "fixture that returns a SQLAlchemy AsyncEngine with access to your test " +
+           "database. For more information, see the plugin documentation: " +
+           "https://github.com/jeancochrane/pytest-flask-sqlalchemy#async-fixtures")
+
+    raise NotImplementedError(msg)
+
+
+@pytest_asyncio.fixture
+async def _async_transaction(pytestconfig, request, _async_db):
+    '''
+    Create a transactional context for async tests to run in, in the same way
+    that `_transaction` does for sync tests.
+    '''
+    dialects.enable_savepoints(_async_db.sync_engine)
+
+    # Start a transaction
+    connection = await _async_db.connect()
+    transaction = await connection.begin()
+
+    # The async objects are wrappers around sync ones, which are where events
+    # get dispatched and the only ones that can be patched
+    sync_connection = connection.sync_connection
+    sync_transaction = transaction.sync_transaction
+
+    profile = None
+    if pytestconfig._sqla_profiler is not None:
+        profile = profiling.get_profile(request.node)
+        profile.watch(sync_connection)
+
+    # Loading expired attributes requires IO, which an async session can't do
+    # implicitly, so follow SQLAlchemy's advice not to expire them on commit
+    options = dict(bind=connection, expire_on_commit=False)
+
+    # Make sure the connection can't be closed by accident in the codebase
+    sync_connection.force_close = sync_connection.close
+    sync_connection.close = lambda: None
+
+    if JOIN_EXTERNAL_TRANSACTIONS:
+        # Let the session run each of its transactions in a SAVEPOINT, the same
+        # way that `_transaction` does
+        session = AsyncSession(join_transaction_mode='create_savepoint', **options)
+        sync_session = session.sync_session
+
+        if profile is not None:
+            @sa.event.listens_for(sync_session, 'after_commit')
+            def count_savepoint(sync_session):
+                profile.savepoints += 1
+    else:
+        session = AsyncSession(**options)
+        sync_session = session.sync_session
+
+        sync_transaction.force_rollback = sync_transaction.rollback
+        sync_session.force_close = sync_session.close
+
+        sync_transaction.rollback = lambda: None
+        sync_session.close = lambda: None
+
+        # Begin a nested transaction (any new transactions created in the codebase
+        # will be held until this outer transaction is committed or closed)
+        await session.begin_nested()
+
+        # Each time the SAVEPOINT for the nested transaction ends, reopen it
+        @sa.event.listens_for(sync_session, 'after_transaction_end')
+        def restart_savepoint(sync_session, trans):
+            if trans.nested and not trans._parent.nested:
+                # Expire state the way a top-level commit would, if the session
+                # has been configured to
+                if sync_session.expire_on_commit:
+                    sync_session.expire_all()
+
+                sync_session.begin_nested()
+
+                if profile is not None:
+                    profile.savepoints += 1
+
+        # If an object gets moved to the 'detached' state by a call to flush the
+        # session, add it back into the session
+        @sa.event.listens_for(sync_session, 'persistent_to_detached')
+        @sa.event.listens_for(sync_session, 'deleted_to_detached')
+        def rehydrate_object(sync_session, obj):
+            sync_session.add(obj)
+
+            if profile is not None:
+                profile.rehydrated += 1
+
+    # Force the connection to use nested transactions
+    sync_connection.begin = sync_connection.begin_nested
+
+    yield connection, transaction, session
+
+    if profile is not None:
+        profile.unwatch(sync_connection)
+
+    # Close the session without reopening its SAVEPOINT, then roll back the
+    # transaction and return the connection to the pool
+    if not JOIN_EXTERNAL_TRANSACTIONS:
+        sa.event.remove(sync_session, 'after_transaction_end', restart_savepoint)
+
+        sync_session.close = sync_session.force_close
+        sync_transaction.rollback = sync_transaction.force_rollback
+
+    sync_connection.close = sync_connection.force_close
+
+    await session.close()
+    await transaction.rollback()
+    await connection.close()
+
+
+@pytest.fixture(scope='session')
+def _async_engine_proxy():
+    '''
+    Create the AsyncEngine stand-in that gets rebound to each test's connection.
+    '''
+    return AsyncTransactionalEngine()
+
+
+@pytest.fixture(scope='function')
+def _async_engine(pytestconfig, request, _async_transaction, _async_engine_proxy):
+    '''
+    Mock out direct access to the semi-global AsyncEngine object.
+    '''
+    connection, _, _ = _async_transaction
+
+    engine = _async_engine_proxy
+    engine.connection = connection
+
+    restore_engines = install_targets(pytestconfig._mocked_async_engines, engine)
+    request.addfinalizer(restore_engines)
+
+    @request.addfinalizer
+    def reset_connection():
+        # Don't hold on to the connection once the test is over
+        engine.connection = None
+
+    return engine
+
+
+@pytest.fixture(scope='function')
+def _async_session(pytestconfig, request, _async_transaction):
+    '''
+    Mock out AsyncSession objects using a transactional context.
+    '''
+    _, _, session = _async_transaction
+
+    restore_sessions = install_targets(pytestconfig._mocked_async_sessions, session)
+    request.addfinalizer(restore_sessions)
+
+    return session
+
+
+@pytest.fixture(scope='function')
+def async_db_session(_async_engine, _async_session, _async_transaction):
+    '''
+    Make an AsyncSession available to a test, and roll back any changes it
+    makes to the database once the test is over.
+    '''
+    return _async_session
+
+
+@pytest.fixture(scope='function')
+def async_db_engine(_async_engine, _async_session, _async_transaction):
+    '''
+    Make a stand-in for an AsyncEngine available to a test, and roll back any
+    changes it makes to the database once the test is over.
+    '''
+    return _async_engine
@@ -0,0 +1,141 @@
+import contextlib
+import copy
+import os
+import shutil
+import time
+
+import sqlalchemy as sa
+
+
+def worker_id():
+    '''
+    Return the ID of the pytest-xdist worker running the current process (like
+    `gw0`), or None if the tests aren't being run with pytest-xdist.
+    '''
+    return os.environ.get('PYTEST_XDIST_WORKER')
+
+
+def render_url(url):
+    '''
+    Render a SQLAlchemy URL as a string, including its password.
+    '''
+    if hasattr(url, 'render_as_string'):
+        return url.render_as_string(hide_password=False)
+    return str(url)
+
+
+def _with_database(url, database):
+    if hasattr(url, 'set'):
+        return url.set(database=database)
+
+    url = copy.copy(url)
+    url.database = database
+    return url
+
+
+def suffixed_url(url, suffix):
+    '''
+    Return a copy of `url` pointing at a database whose name is the name of the
+    original database with `suffix` appended to it. For SQLite, the suffix is
+    added to the file name, before the extension.
+    '''
+    root, ext = os.path.splitext(url.database)
+    return _with_database(url, '{}_{}{}'.format(root, suffix, ext))
+
+
+def _check_backend(url):
+    if url.get_backend_name() == 'sqlite':
+        if not url.database or url.database == ':memory:':
+            raise ValueError('Copying databases requires a file-based SQLite database')
+    elif url.get_backend_name() != 'postgresql':
+        raise ValueError('Copying databases is not supported for the ' +
+                         '{} backend'.format(url.get_backend_name()))
+
+
+@contextlib.contextmanager
+def _maintenance_connection(url):
+    '''
+    Connect to the default `postgres` database on the server hosting `url`, in
+    autocommit mode so that databases can be created and dropped.
+    '''
+    engine = sa.create_engine(render_url(_with_database(url, 'postgres')),
+                              isolation_level='AUTOCOMMIT')
+    try:
+        with engine.connect() as connection:
+            yield connection
+    finally:
+        engine.dispose()
+
+
+def database_exists(url):
+    '''
+    Check whether the database at `url` exists.
+    '''
+    _check_backend(url)
+
+    if url.get_backend_name() == 'sqlite':
+        return os.path.exists(url.database)
+
+    with _maintenance_connection(url) as connection:
+        query = sa.text('SELECT 1 FROM pg_database WHERE datname = :name')
+        return connection.execute(query, {'name': url.database}).scalar() is not None
+
+
+def drop_database(url):
+    '''
+    Drop the database at `url` if it exists.
+    '''
+    _check_backend(url)
+
+    if url.get_backend_name() == 'sqlite':
+        if os.path.exists(url.database):
+            os.remove(url.database)
+        return
+
+    with _maintenance_connection(url) as connection:
+        connection.execute(sa.text('DROP DATABASE IF EXISTS "{}"'.format(url.database)))
+
+
+def create_database(url, template=None):
+    '''
+    Create an empty database at `url`, or a copy of the database at `template`
+    if one is provided. Any existing database at `url` is dropped first.
+    '''
+    drop_database(url)
+
+    if url.get_backend_name() == 'sqlite':
+        if template is not None:
+            shutil.copyfile(template.database, url.database)
+        else:
+            sa.create_engine(render_url(url)).dispose()
+        return
+
+    with _maintenance_connection(url) as connection:
+        if template is not None:
+            connection.execute(sa.text('CREATE DATABASE "{}" TEMPLATE "{}"'.format(
+                url.database, template.database)))
+        else:
+            connection.execute(sa.text('CREATE DATABASE "{}"'.format(url.database)))
+
+
+@contextlib.contextmanager
+def file_lock(path, timeout=300, interval=0.05):
+    '''
+    Hold an exclusive lock, shared between processes, on the file at `path`.
+    '''
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if time.time() > deadline:
+                raise TimeoutError('Timed out waiting for lock on {}'.format(path))
+            time.sleep(interval)
+        else:
+            break
+
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.remove(path)
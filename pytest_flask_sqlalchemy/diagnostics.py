@@ -0,0 +1,174 @@
+import re
+import warnings
+
+import sqlalchemy as sa
+from sqlalchemy.event import registry as event_registry
+
+
+# The ini options that set the thresholds past which a test gets a warning,
+# and the diagnostic each one applies to
+THRESHOLDS = {
+    'warn-savepoint-depth': 'max_savepoint_depth',
+    'warn-savepoints': 'savepoints',
+    'warn-leaked-listeners': 'leaked_listeners',
+    'warn-registry-objects': 'registry_objects',
+}
+
+SAVEPOINT_COMMAND = re.compile(r'^\s*(SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT)\s+"?([^"\s;]+)',
+                               re.IGNORECASE)
+
+
+class DiagnosticWarning(UserWarning):
+    '''
+    Warn that a test went past one of the thresholds set with the `warn-*` options.
+    '''
+
+
+def listener_keys(targets):
+    '''
+    Return the keys of the event listeners registered on any of `targets`, or
+    None if this version of SQLAlchemy doesn't keep them where we can find them.
+    '''
+    # SQLAlchemy keeps every listener in a registry keyed by the id of the
+    # object it was registered on, whichever kind of object that is. The
+    # registry is private, so don't count on it being there
+    key_to_collection = getattr(event_registry, '_key_to_collection', None)
+    if key_to_collection is None:
+        return None
+
+    ids = {id(target) for target in targets}
+    return {key for key in list(key_to_collection) if key[0] in ids}
+
+
+def registry_sessions(scoped_session):
+    '''
+    Return the sessions that a scoped session's registry is holding on to.
+    '''
+    registry = scoped_session.registry
+    sessions = getattr(registry, 'registry', None)
+    if isinstance(sessions, dict):
+        return list(sessions.values())
+
+    # Thread-local registries only show the session of the current thread
+    return [registry()] if registry.has() else []
+
+
+class ConnectionDiagnostics(object):
+    '''
+    Record the savepoints that a test opens on its connections, and what it
+    leaves behind once it's torn down: event listeners still attached to the
+    objects that outlive it, and sessions still in the scoped-session
+    registries, along with the objects they keep alive.
+
+    The depth of the savepoint stack is the one the database sees, where
+    rolling back to a savepoint keeps it open.
+    '''
+    def __init__(self, nodeid):
+        self.nodeid = nodeid
+        self.savepoints = 0
+        self.max_savepoint_depth = 0
+        self.leaked_listeners = 0
+        self.registry_sessions = 0
+        self.registry_objects = 0
+
+        # The names of the open savepoints, innermost last
+        self._stack = []
+
+        self._targets = []
+        self._listener_keys = set()
+
+    def __repr__(self):
+        return '<ConnectionDiagnostics {}>'.format(self.nodeid)
+
+    def watch(self, connection):
+        '''
+        Start tracking the savepoints opened on a connection.
+        '''
+        sa.event.listen(connection, 'after_cursor_execute', self._after_cursor_execute)
+
+    def unwatch(self, connection):
+        if sa.event.contains(connection, 'after_cursor_execute', self._after_cursor_execute):
+            sa.event.remove(connection, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        match = SAVEPOINT_COMMAND.match(statement)
+        if match is None:
+            return
+
+        command, name = match.group(1).upper(), match.group(2)
+        if command == 'SAVEPOINT':
+            self.savepoints += 1
+            self._stack.append(name)
+            self.max_savepoint_depth = max(self.max_savepoint_depth, len(self._stack))
+            return
+
+        # Ignore savepoints that were opened before the test started
+        if name not in self._stack:
+            return
+
+        # Releasing a savepoint releases the ones inside it as well, and
+        # rolling back to it does the same but keeps it open
+        index = len(self._stack) - 1 - self._stack[::-1].index(name)
+        if command == 'ROLLBACK TO SAVEPOINT':
+            index += 1
+        del self._stack[index:]
+
+    def track_listeners(self, targets):
+        '''
+        Take note of the event listeners registered on objects that outlive the
+        test, so that the ones it adds can be found once it's torn down.
+        '''
+        self._targets = [target for target in targets if target is not None]
+        self._listener_keys = listener_keys(self._targets)
+
+    def check_listeners(self):
+        keys = listener_keys(self._targets)
+        if keys is None or self._listener_keys is None:
+            return
+
+        self.leaked_listeners = len(keys - self._listener_keys)
+
+    def check_registries(self, scoped_sessions):
+        '''
+        Count the sessions that scoped-session registries still hold once the
+        test is over, and the objects in them.
+        '''
+        self.registry_sessions = 0
+        self.registry_objects = 0
+        for scoped_session in scoped_sessions:
+            if scoped_session is None or not hasattr(scoped_session, 'registry'):
+                continue
+
+            for session in registry_sessions(scoped_session):
+                self.registry_sessions += 1
+                self.registry_objects += (len(session.identity_map) + len(session.new) +
+                                          len(session.deleted))
+
+    def warn(self, thresholds):
+        '''
+        Issue a `DiagnosticWarning` for each diagnostic that is past the
+        threshold set for it.
+        '''
+        messages = {
+            'max_savepoint_depth': '{} nested savepoints were open at once',
+            'savepoints': '{} savepoints were opened',
+            'leaked_listeners': '{} event listeners were still attached after teardown',
+            'registry_objects': ('{{}} objects were kept alive by {} sessions left in the '
+                                 'scoped-session registry'.format(self.registry_sessions)),
+        }
+
+        for option, threshold in thresholds.items():
+            name = THRESHOLDS[option]
+            value = getattr(self, name)
+            if threshold is not None and value > threshold:
+                warnings.warn(DiagnosticWarning('{}: {} ({} is {})'.format(
+                    self.nodeid, messages[name].format(value), option, threshold)))
+
+    def as_dict(self):
+        return {
+            'savepoints': self.savepoints,
+            'max_savepoint_depth': self.max_savepoint_depth,
+            'leaked_listeners': self.leaked_listeners,
+            'registry_sessions': self.registry_sessions,
+            'registry_objects': self.registry_objects,
+        }
@@ -0,0 +1,151 @@
+import sqlalchemy as sa
+
+
+def is_memory_database(url):
+    '''
+    Check whether a SQLAlchemy URL points to an in-memory SQLite database.
+    '''
+    return (url.get_backend_name() == 'sqlite' and
+            url.database in (None, '', ':memory:'))
+
+
+def dbapi_connection(connection):
+    '''
+    Return the DBAPI connection underneath a SQLAlchemy Connection.
+    '''
+    fairy = connection.connection
+
+    # SQLAlchemy 1.4.24 renamed the attribute holding the DBAPI connection
+    if hasattr(fairy, 'dbapi_connection'):
+        return fairy.dbapi_connection
+    return fairy.connection
+
+
+# SQLite drivers built on the standard library's sqlite3 module
+SQLITE3_DRIVERS = {'pysqlite', 'aiosqlite'}
+
+
+def _begin_sqlite3(connection):
+    # sqlite3 only stops managing transactions on its own once its isolation
+    # level is None, after which nothing emits BEGIN unless SQLAlchemy does
+    dbapi = dbapi_connection(connection)
+    if dbapi.isolation_level is not None:
+        dbapi.isolation_level = None
+
+    # Leave alone any transaction that a listener in the user's conftest has
+    # already begun (the aiosqlite adapter doesn't report this)
+    if not getattr(dbapi, 'in_transaction', False):
+        getattr(connection, 'exec_driver_sql', connection.execute)('BEGIN')
+
+
+def enable_savepoints(engine):
+    '''
+    Make SAVEPOINTs work on a (synchronous) engine, which takes some help for
+    the sqlite3 drivers. By default they defer BEGIN until the first write and
+    commit whenever the outermost SAVEPOINT is released, both of which break the
+    nested transactions that isolate each test. See:
+    https://docs.sqlalchemy.org/en/latest/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl
+    '''
+    if engine.dialect.name != 'sqlite' or engine.dialect.driver not in SQLITE3_DRIVERS:
+        return
+
+    if not sa.event.contains(engine, 'begin', _begin_sqlite3):
+        sa.event.listen(engine, 'begin', _begin_sqlite3)
+
+
+def savepoint(connection, name):
+    '''
+    Start a SAVEPOINT using the syntax of the connection's dialect.
+    '''
+    connection.dialect.do_savepoint(connection, name)
+
+
+def rollback_to_savepoint(connection, name):
+    '''
+    Roll back to a SAVEPOINT using the syntax of the connection's dialect.
+    '''
+    connection.dialect.do_rollback_to_savepoint(connection, name)
+
+
+def release_savepoint(connection, name):
+    '''
+    Release a SAVEPOINT using the syntax of the connection's dialect.
+    '''
+    connection.dialect.do_release_savepoint(connection, name)
+
+
+# The statement that makes the transaction it's run in read-only, with one
+# snapshot of the database throughout, for the dialects that support it. It
+# has to come before any other statement in the transaction
+READ_ONLY_TRANSACTIONS = {
+    'postgresql': 'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY',
+    'mysql': 'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY',
+    'mariadb': 'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY',
+}
+
+
+def begin_read_only(connection):
+    '''
+    Begin a transaction on a connection, which is read-only if its dialect
+    supports it, and return the transaction.
+    '''
+    transaction = connection.begin()
+
+    statement = READ_ONLY_TRANSACTIONS.get(connection.dialect.name)
+    if statement is not None:
+        getattr(connection, 'exec_driver_sql', connection.execute)(statement)
+
+    return transaction
+
+
+# The prefix that turns a statement into one that shows its query plan, for
+# the dialects that support it
+EXPLAIN_PREFIXES = {
+    'postgresql': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'mysql': 'EXPLAIN ',
+    'mariadb': 'EXPLAIN ',
+}
+
+
+def explain(connection, statement, parameters):
+    '''
+    Return the query plan of a statement that ran on a connection as a list of
+    lines, or None if the connection's dialect can't show it. The plan is looked
+    up in the same transaction, without running the statement again.
+    '''
+    prefix = EXPLAIN_PREFIXES.get(connection.dialect.name)
+    if prefix is None:
+        return None
+
+    # A failed statement aborts the whole transaction on Postgres, so give the
+    # EXPLAIN a SAVEPOINT of its own to fail in
+    isolate = connection.dialect.name == 'postgresql'
+
+    # Go straight to the DBAPI connection, since the statement that's being
+    # explained may still be running on the SQLAlchemy connection
+    cursor = dbapi_connection(connection).cursor()
+    try:
+        if isolate:
+            cursor.execute('SAVEPOINT sqla_explain')
+
+        try:
+            cursor.execute(prefix + statement, parameters)
+            rows = cursor.fetchall()
+        except connection.dialect.dbapi.Error:
+            rows = None
+
+        if isolate:
+            cursor.execute('ROLLBACK TO SAVEPOINT sqla_explain')
+            cursor.execute('RELEASE SAVEPOINT sqla_explain')
+    finally:
+        cursor.close()
+
+    if rows is None:
+        return None
+
+    # Postgres returns a line of the plan per row, and SQLite a node of the
+    # plan with its description in the last column
+    if connection.dialect.name in ('postgresql', 'sqlite'):
+        return [str(row[-1]) for row in rows]
+    return [' | '.join(str(value) for value in row) for row in rows]
@@ -0,0 +1,252 @@
+import contextlib
+import itertools
+
+import sqlalchemy as sa
+from packaging import version
+
+from . import dialects, locking
+
+
+SQLALCHEMY_VERSION = version.parse(sa.__version__)
+
+
+class TransactionalEngine(object):
+    '''
+    A stand-in for a SQLAlchemy Engine that redirects all database access to the
+    connection of the test that is currently running.
+
+    A single instance is created for the whole test session, and the `_engine`
+    fixture rebinds it to each new test's connection, which is much cheaper than
+    building a new `MagicMock(spec=Engine)` for every test.
+    '''
+    def __init__(self, connection=None):
+        self._connection = connection
+
+        # A `LazyTransaction` to take the connection from, once it's needed
+        self.transaction = None
+
+        # The `RawConnectionProxy` objects whose savepoints are open on the
+        # connection, innermost last, and the source of their savepoint names
+        self.raw_connections = []
+        self._raw_savepoint_ids = itertools.count(1)
+
+    def __repr__(self):
+        return '<TransactionalEngine connection={!r}>'.format(self._connection)
+
+    def __getattr__(self, name):
+        '''
+        Look up anything that isn't redirected to the test's connection, like
+        `pool`, `echo` or `dispose()`, on the real Engine behind it.
+        '''
+        # Special methods looked up before `__init__` has run, by `copy` for
+        # instance, would otherwise recurse through `connection`
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        return getattr(self.connection.engine, name)
+
+    @property
+    def connection(self):
+        '''
+        The connection of the test that is currently running, which only gets
+        opened the first time the engine is used.
+        '''
+        if self._connection is None and self.transaction is not None:
+            self._connection = self.transaction.connection
+        return self._connection
+
+    @connection.setter
+    def connection(self, connection):
+        self._connection = connection
+
+        # Raw connections only live as long as the connection they came from
+        self.raw_connections = []
+
+    @property
+    def dialect(self):
+        '''
+        References to `Engine.dialect` should redirect to the Connection (this
+        is primarily useful for the `autoload` flag in SQLAlchemy, which references
+        the Engine dialect to reflect tables).
+        '''
+        return self.connection.dialect
+
+    @property
+    def url(self):
+        return self.connection.engine.url
+
+    @property
+    def name(self):
+        return self.connection.engine.name
+
+    @property
+    def driver(self):
+        return self.connection.engine.driver
+
+    def connect(self, *args, **kwargs):
+        '''
+        Return a reference to the open connection.
+        '''
+        return self.connection
+
+    # Threadlocal engine strategies were deprecated in SQLAlchemy 1.3, which
+    # resulted in contextual_connect becoming a private method. See:
+    # https://docs.sqlalchemy.org/en/latest/changelog/migration_13.html
+    if SQLALCHEMY_VERSION < version.parse('1.3'):
+        contextual_connect = connect
+    elif SQLALCHEMY_VERSION < version.parse('1.4'):
+        _contextual_connect = connect
+
+    @contextlib.contextmanager
+    def begin(self):
+        '''
+        Open a new nested transaction on the connection.
+        '''
+        with self.connection.begin_nested():
+            yield self.connection
+
+    def execute(self, *args, **kwargs):
+        return self.connection.execute(*args, **kwargs)
+
+    def raw_connection(self):
+        '''
+        Return a stand-in for the DBAPI connection underlying the test's
+        connection, which works inside a SAVEPOINT of its own.
+        '''
+        return RawConnectionProxy(self, self.connection)
+
+    def _next_raw_savepoint(self):
+        return 'raw_conn_{}'.format(next(self._raw_savepoint_ids))
+
+
+class RawConnectionProxy(object):
+    '''
+    A stand-in for the DBAPI connection returned by `raw_connection()`, which
+    leaves the real DBAPI connection untouched.
+
+    Each proxy works inside a uniquely named SAVEPOINT on the test's connection:
+    `commit()` releases it and begins a new one, `rollback()` rolls back to it,
+    and `close()` releases it. Raw connections checked out one after another
+    nest, so ending the savepoint of one also ends the savepoints of the ones
+    checked out after it, which begin new savepoints the next time they commit
+    or roll back. Everything else, including cursors, goes straight to the
+    DBAPI connection.
+    '''
+    # Attributes that would take the DBAPI connection out of the test's
+    # transaction if they were changed
+    IGNORED_ATTRIBUTES = {'autocommit', 'isolation_level'}
+
+    def __init__(self, engine, connection):
+        object.__setattr__(self, '_engine', engine)
+        object.__setattr__(self, '_connection', connection)
+        object.__setattr__(self, '_dbapi_connection', dialects.dbapi_connection(connection))
+        object.__setattr__(self, 'savepoint', None)
+
+        self._begin()
+
+    def __repr__(self):
+        return '<RawConnectionProxy savepoint={!r}>'.format(self.savepoint)
+
+    def __getattr__(self, name):
+        return getattr(self._dbapi_connection, name)
+
+    def __setattr__(self, name, value):
+        if name not in self.IGNORED_ATTRIBUTES:
+            setattr(self._dbapi_connection, name, value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def _begin(self):
+        name = self._engine._next_raw_savepoint()
+        dialects.savepoint(self._connection, name)
+
+        object.__setattr__(self, 'savepoint', name)
+        self._engine.raw_connections.append(self)
+
+    def _end(self, rollback=False):
+        '''
+        End this proxy's savepoint, along with the ones nested inside it.
+        Rolling back keeps the savepoint open, the way the database does.
+        '''
+        if self.savepoint is None:
+            return
+
+        stack = self._engine.raw_connections
+        index = stack.index(self)
+        for proxy in stack[index + 1:]:
+            object.__setattr__(proxy, 'savepoint', None)
+
+        if rollback:
+            dialects.rollback_to_savepoint(self._connection, self.savepoint)
+            del stack[index + 1:]
+        else:
+            dialects.release_savepoint(self._connection, self.savepoint)
+            object.__setattr__(self, 'savepoint', None)
+            del stack[index:]
+
+    def cursor(self, *args, **kwargs):
+        # Threads that share the test's connection take turns on its cursors too
+        transaction = self._engine.transaction
+        lock = transaction.lock if transaction is not None else None
+
+        return RawCursorProxy(self._dbapi_connection.cursor(*args, **kwargs), self, lock=lock)
+
+    def commit(self):
+        self._end()
+        self._begin()
+
+    def rollback(self):
+        if self.savepoint is None:
+            self._begin()
+        else:
+            self._end(rollback=True)
+
+    def close(self):
+        self._end()
+
+    def set_isolation_level(self, level):
+        # psycopg2 can switch a connection to autocommit, which would end the
+        # test's transaction
+        pass
+
+
+class RawCursorProxy(object):
+    '''
+    A cursor of a `RawConnectionProxy`, whose `connection` is the proxy rather
+    than the real DBAPI connection. Every other attribute belongs to the
+    cursor, so bulk methods like `executemany()` and psycopg2's `copy_from()`
+    and `copy_expert()` run at full speed. When the threads sharing the
+    connection are serialised, the methods that run statements hold `lock`.
+    '''
+    def __init__(self, cursor, connection, lock=None):
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, 'connection', connection)
+        object.__setattr__(self, '_lock', lock)
+
+    def __repr__(self):
+        return '<RawCursorProxy cursor={!r}>'.format(self._cursor)
+
+    def __getattr__(self, name):
+        value = getattr(self._cursor, name)
+        if self._lock is not None and name in locking.LOCKED_CURSOR_METHODS:
+            return locking.locked(value, self._lock)
+        return value
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._cursor.close()
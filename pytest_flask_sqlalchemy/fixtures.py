@@ -1,10 +1,23 @@
-import os
 import contextlib
+import os
 
 import pytest
 import sqlalchemy as sa
 from packaging import version
 
+from . import (databases, diagnostics, dialects, isolation, locking, profiling, schema, seeds,
+               teardown)
+from .engine import TransactionalEngine
+from .patching import install_targets
+from .readonly import ReadOnlySnapshot
+from .reference import ReferenceCache
+from .sessions import (JOIN_EXTERNAL_TRANSACTIONS, FakeSessionMaker, SessionFactory,
+                       create_scoped_session)
+from .transaction import LazyTransaction
+
+
+PYTEST_VERSION = version.parse(pytest.__version__)
+
 
 @pytest.fixture(scope='module')
 def _db():
@@ -22,170 +35,804 @@ def _db():
     raise NotImplementedError(msg)
 
 
-@pytest.fixture(scope='function')
-def _transaction(request, _db, mocker):
+@pytest.fixture(scope='session')
+def _schema_cache(pytestconfig):
+    '''
+    Track the schemas built into test databases when the `schema-cache` option
+    is enabled.
+    '''
+    return schema.SchemaCache(getattr(pytestconfig, 'cache', None),
+                              enabled=pytestconfig._schema_cache)
+
+
+@pytest.fixture(scope='session')
+def db_create_all(_schema_cache):
+    '''
+    Return a function that can stand in for `SQLAlchemy.create_all()` in user
+    fixtures. With the `schema-cache` option enabled, it skips building tables
+    when the database already holds a schema built from the same metadata.
+    '''
+    return _schema_cache.create_all
+
+
+def _fixture_scope(request, name):
+    '''
+    Return the scope of the fixture called `name` that the test being set up
+    would get, or None if there's no such fixture.
     '''
-    Create a transactional context for tests to run in.
+    item = request._pyfuncitem
+
+    # pytest 8.1 looks up the fixtures that apply to a node by the node itself,
+    # rather than by its ID
+    if PYTEST_VERSION >= version.parse('8.1'):
+        fixturedefs = request._fixturemanager.getfixturedefs(name, item)
+    else:
+        fixturedefs = request._fixturemanager.getfixturedefs(name, item.nodeid)
+
+    if not fixturedefs:
+        return None
+
+    # The closest definition overrides the others
+    return fixturedefs[-1].scope
+
+
+@pytest.fixture(scope='session', autouse=True)
+def _worker_database(pytestconfig, request, tmp_path_factory, _schema_cache):
+    '''
+    When the `xdist-databases` option is enabled and the tests are running under
+    pytest-xdist, give each worker its own database and bind `_db` to it. Worker
+    databases are cloned from a template database, which is built by whichever
+    worker gets there first and dropped by whichever finishes last.
+    '''
+    worker = databases.worker_id()
+    if not pytestconfig._xdist_databases or worker is None:
+        return None
+
+    # The worker database has to stay bound for the whole session, so `_db`
+    # can't be torn down and rebuilt along the way
+    if _fixture_scope(request, '_db') != 'session':
+        raise pytest.UsageError('The xdist-databases option requires the _db fixture ' +
+                                'to be session-scoped')
+
+    _db = request.getfixturevalue('_db')
+    if not (hasattr(_db, 'get_app') or hasattr(_db, 'engines')):
+        raise TypeError('The xdist-databases option requires a _db fixture that ' +
+                        'returns a Flask-SQLAlchemy SQLAlchemy object')
+
+    # Each worker is a separate process, so an in-memory database is already
+    # private to it
+    url = _db.engine.url
+    if dialects.is_memory_database(url):
+        return None
+
+    template_url = databases.suffixed_url(url, 'template')
+    worker_url = databases.suffixed_url(url, worker)
+
+    # The parent of the base temporary directory is shared by all of the
+    # workers in a run, so it can coordinate building the template
+    shared_dir = tmp_path_factory.getbasetemp().parent
+    template_built = shared_dir / 'pytest_flask_sqlalchemy_template'
+    running_workers = shared_dir / 'pytest_flask_sqlalchemy_workers'
+    lock_path = str(shared_dir / 'pytest_flask_sqlalchemy.lock')
+
+    metadata_fingerprint = schema.fingerprint(_db.metadata)
+
+    with databases.file_lock(lock_path):
+        if not template_built.exists():
+            # Reuse the template from an earlier run if the schema hasn't changed
+            if not (_schema_cache.is_current(template_url, metadata_fingerprint) and
+                    databases.database_exists(template_url)):
+                databases.create_database(template_url)
+
+                template_engine = sa.create_engine(databases.render_url(template_url))
+                _db.metadata.create_all(bind=template_engine)
+                template_engine.dispose()
+
+                _schema_cache.record(template_url, metadata_fingerprint)
+
+            template_built.touch()
+
+        databases.create_database(worker_url, template=template_url)
+
+        running = int(running_workers.read_text()) if running_workers.exists() else 0
+        running_workers.write_text(str(running + 1))
+
+    _schema_cache.record(worker_url, metadata_fingerprint, persist=False)
+
+    if hasattr(_db, 'get_app'):
+        # Flask-SQLAlchemy 2 builds its engine from the app config, and replaces
+        # it when the database URI changes
+        app = _db.get_app()
+        original_uri = app.config['SQLALCHEMY_DATABASE_URI']
+        app.config['SQLALCHEMY_DATABASE_URI'] = databases.render_url(worker_url)
+
+        def restore_engine():
+            _db.engine.dispose()
+            app.config['SQLALCHEMY_DATABASE_URI'] = original_uri
+    else:
+        # Flask-SQLAlchemy 3 builds its engines once, when it's set up on the
+        # app, so swap in an engine for the worker database directly
+        engines = _db.engines
+        original_engine = engines[None]
+        engines[None] = sa.create_engine(databases.render_url(worker_url))
+
+        def restore_engine():
+            engines[None].dispose()
+            engines[None] = original_engine
+
+    @request.addfinalizer
+    def drop_worker_database():
+        # Close any pooled connections, since a database that is in use can't
+        # be dropped
+        restore_engine()
+
+        databases.drop_database(worker_url)
+
+        with databases.file_lock(lock_path):
+            running = int(running_workers.read_text()) - 1
+            running_workers.write_text(str(running))
+            if running > 0:
+                return
+
+            # A worker that only starts after this one builds the template again.
+            # With the schema cache enabled, the template is kept for the next run
+            template_built.unlink()
+            if not _schema_cache.enabled:
+                databases.drop_database(template_url)
+
+    return worker_url
+
+
+def _pin_connection(request, _db):
     '''
-    # Start a transaction
+    Open a connection and outer transaction that stay pinned until the
+    fixture requesting them is torn down.
+    '''
+    dialects.enable_savepoints(_db.engine)
+
     connection = _db.engine.connect()
     transaction = connection.begin()
 
-    # Bind a session to the transaction. The empty `binds` dict is necessary
-    # when specifying a `bind` option, or else Flask-SQLAlchemy won't scope
-    # the connection properly
+    # Make sure the connection and transaction can't be closed by accident in
+    # the codebase. (SQLAlchemy 2.0 transactions can't be patched, but nothing
+    # can reach the outer transaction once the connection only begins nested ones)
+    connection.force_close = connection.close
+    connection.close = lambda: None
+
+    if not JOIN_EXTERNAL_TRANSACTIONS:
+        transaction.force_rollback = transaction.rollback
+        transaction.rollback = lambda: None
+
+    # Force the connection to use nested transactions
+    connection.begin = connection.begin_nested
+
+    @request.addfinalizer
+    def teardown_connection():
+        getattr(transaction, 'force_rollback', transaction.rollback)()
+        connection.force_close()
+
+    return connection, transaction
+
+
+def _pin_savepoint(request, connection, transaction):
+    '''
+    Begin a SAVEPOINT on a pinned connection, which gets rolled back once the
+    fixture requesting it is torn down.
+    '''
+    savepoint = connection.begin_nested()
+    request.addfinalizer(lambda: _rollback_to_savepoint(connection, savepoint))
+
+    return connection, transaction
+
+
+@pytest.fixture(scope='session')
+def _connection(request, _db):
+    '''
+    Open a single connection and outer transaction that stay pinned for the
+    whole test session (and therefore for each pytest-xdist worker, since every
+    worker runs its own session). Used by `_transaction` when the
+    `reuse-connection` option is enabled.
+    '''
+    return _pin_connection(request, _db)
+
+
+@pytest.fixture(scope='module')
+def _module_connection(pytestconfig, request, _db):
+    '''
+    Pin a connection and outer transaction for the tests of a module, so that
+    data loaded by module-scoped fixtures is only rolled back once the module
+    is done. With the `reuse-connection` option enabled, a SAVEPOINT on the
+    session's connection stands in for the transaction.
+    '''
+    if pytestconfig._reuse_connection:
+        return _pin_savepoint(request, *request.getfixturevalue('_connection'))
+
+    return _pin_connection(request, _db)
+
+
+@pytest.fixture(scope='class')
+def _class_connection(request, _module_connection):
+    '''
+    Isolate the tests of a class inside a SAVEPOINT on the module's connection,
+    so that data loaded by class-scoped fixtures is only rolled back once the
+    class is done.
+    '''
+    return _pin_savepoint(request, *_module_connection)
+
+
+def _layer_session(request, _db, connection):
+    '''
+    Create a session for loading data into a module or class layer.
+    '''
     options = dict(bind=connection, binds={})
-    session = _db.create_scoped_session(options=options)
 
-    # Make sure the session, connection, and transaction can't be closed by accident in
-    # the codebase
-    connection.force_close = connection.close
-    transaction.force_rollback = transaction.rollback
+    if JOIN_EXTERNAL_TRANSACTIONS:
+        options['join_transaction_mode'] = 'create_savepoint'
 
-    connection.close = lambda: None
-    transaction.rollback = lambda: None
+        session = create_scoped_session(_db, options)
+        request.addfinalizer(session.remove)
+
+        return session
+
+    # Older sessions take over the SAVEPOINT at the top of the connection's
+    # stack, and roll it back when they're closed. Give the session one of its
+    # own, rather than let it take the layer's
+    savepoint = connection.begin_nested()
+
+    session = create_scoped_session(_db, options)
     session.close = lambda: None
 
-    # Begin a nested transaction (any new transactions created in the codebase
-    # will be held until this outer transaction is committed or closed)
+    # Keep the session's commits inside a nested transaction, the same way that
+    # `_transaction` does
     session.begin_nested()
 
-    # Each time the SAVEPOINT for the nested transaction ends, reopen it
     @sa.event.listens_for(session, 'after_transaction_end')
     def restart_savepoint(session, trans):
         if trans.nested and not trans._parent.nested:
-            # ensure that state is expired the way
-            # session.commit() at the top level normally does
             session.expire_all()
-
             session.begin_nested()
 
-    # Force the connection to use nested transactions
-    connection.begin = connection.begin_nested
-
-    # If an object gets moved to the 'detached' state by a call to flush the session,
-    # add it back into the session (this allows us to see changes made to objects
-    # in the context of a test, even when the change was made elsewhere in
-    # the codebase)
-    @sa.event.listens_for(session, 'persistent_to_detached')
-    @sa.event.listens_for(session, 'deleted_to_detached')
-    def rehydrate_object(session, obj):
-        session.add(obj)
-
     @request.addfinalizer
-    def teardown_transaction():
-        # Delete the session
+    def teardown_session():
+        _rollback_to_savepoint(connection, savepoint)
         session.remove()
 
-        # Rollback the transaction and return the connection to the pool
-        transaction.force_rollback()
-        connection.force_close()
+    return session
+
+
+@pytest.fixture(scope='module')
+def db_session_module(request, _db, _module_connection):
+    '''
+    Return a Session for module-scoped fixtures to load data with. The data is
+    visible to every test in the module, whose own changes are rolled back
+    after each test, and is rolled back once the module is done.
+    '''
+    connection, _ = _module_connection
+    return _layer_session(request, _db, connection)
+
+
+@pytest.fixture(scope='class')
+def db_session_class(request, _db, _class_connection):
+    '''
+    Return a Session for class-scoped fixtures to load data with. The data is
+    visible to every test in the class, whose own changes are rolled back after
+    each test, and is rolled back once the class is done.
+    '''
+    connection, _ = _class_connection
+    return _layer_session(request, _db, connection)
+
 
-    return connection, transaction, session
+@pytest.fixture(scope='module')
+def _readonly_snapshot(request, _db):
+    '''
+    Create the read-only snapshot that `db_session_readonly` hands out.
+    '''
+    snapshot = ReadOnlySnapshot(_db)
+    request.addfinalizer(snapshot.release)
+
+    return snapshot
 
 
 @pytest.fixture(scope='function')
-def _engine(pytestconfig, request, _transaction, mocker):
+def db_session_readonly(request, _readonly_snapshot):
     '''
-    Mock out direct access to the semi-global Engine object.
+    Return a Session bound to a read-only transaction, which consecutive tests
+    that use this fixture share instead of each opening their own. Statements
+    that may write to the database fail with a `ReadOnlyError`.
     '''
-    connection, _, session = _transaction
+    if '_isolation' in request.fixturenames:
+        pytest.fail('db_session_readonly can\'t be used along with the transactional fixtures',
+                    pytrace=False)
+
+    # Let the plugin keep the snapshot open for the next test, if it uses the
+    # snapshot as well
+    request.node._sqla_readonly_snapshot = _readonly_snapshot
+    request.addfinalizer(_readonly_snapshot.check)
 
-    # Make sure that any attempts to call `connect()` simply return a
-    # reference to the open connection
-    engine = mocker.MagicMock(spec=sa.engine.Engine)
+    return _readonly_snapshot.open()
 
-    engine.connect.return_value = connection
 
-    # Threadlocal engine strategies were deprecated in SQLAlchemy 1.3, which
-    # resulted in contextual_connect becoming a private method. See:
-    # https://docs.sqlalchemy.org/en/latest/changelog/migration_13.html
-    if version.parse(sa.__version__) < version.parse('1.3'):
-        engine.contextual_connect.return_value = connection
-    elif version.parse(sa.__version__) < version.parse('1.4'):
-        engine._contextual_connect.return_value = connection
+@pytest.fixture(scope='session')
+def _background_teardown(pytestconfig, request):
+    '''
+    Start the threads that release the connections of finished tests, when the
+    `background-teardown` option is set, and wait for them at the end of the run.
+    '''
+    if pytestconfig._background_teardown is None:
+        return None
+
+    background = teardown.BackgroundTeardown(pytestconfig._background_teardown)
+    request.addfinalizer(background.shutdown)
+
+    return background
+
+
+@pytest.fixture(scope='module')
+def db_reference_models():
+    '''
+    Return the models of the reference tables whose rows get loaded once and
+    put in the session of every test. Override this fixture to declare them.
+    '''
+    return []
 
-    # References to `Engine.dialect` should redirect to the Connection (this
-    # is primarily useful for the `autoload` flag in SQLAlchemy, which references
-    # the Engine dialect to reflect tables)
-    engine.dialect = connection.dialect
 
-    @contextlib.contextmanager
+@pytest.fixture(scope='module')
+def _reference_cache(_db, db_reference_models):
+    '''
+    Load the rows of the reference models, if there are any.
+    '''
+    if not db_reference_models:
+        return None
+
+    cache = ReferenceCache(_db, db_reference_models)
+    cache.load()
+
+    return cache
+
+
+@pytest.fixture(scope='session')
+def _seed_cache():
+    '''
+    Keep the seed files that tests load parsed for the rest of the test run.
+    '''
+    return seeds.SeedCache()
+
+
+def _metadatas(_db):
+    '''
+    Return the MetaData objects of a Flask-SQLAlchemy object, keyed by bind key.
+    '''
+    # Flask-SQLAlchemy 3 keeps one for each bind, and older versions a single
+    # one that holds the tables of every bind
+    return getattr(_db, 'metadatas', None) or {None: _db.metadata}
+
+
+def _load_seeds(request, _db, transaction, seed_cache, paths):
+    '''
+    Insert the rows in the seed files at `paths`, relative to the directory of
+    the test module, on the connections that the test runs on.
+    '''
+    directory = os.path.dirname(str(request.node.fspath))
+    paths = [os.path.join(directory, path) for path in paths]
+
+    try:
+        data = seed_cache.load(paths)
+
+        if transaction is not None:
+            return seeds.insert(_metadatas(_db), data,
+                                lambda key: transaction.binds.get(key, transaction).connection)
+
+        # The test commits for real, so the seed data does too, and the
+        # isolation strategy removes it along with the rest of the test's changes
+        engines = _bind_engines(_db)
+        engines[None] = _db.engine
+
+        with contextlib.ExitStack() as stack:
+            connections = {}
+
+            def connection_for(key):
+                if key not in connections:
+                    connections[key] = stack.enter_context(engines[key].begin())
+                return connections[key]
+
+            return seeds.insert(_metadatas(_db), data, connection_for)
+    except ValueError as e:
+        pytest.fail(str(e), pytrace=False)
+
+
+def _load_seed_markers(request, _db, transaction):
+    '''
+    Load the seed files listed by the `seed` markers of a test, starting with
+    the markers of its module.
+    '''
+    paths = [path for marker in reversed(list(request.node.iter_markers('seed')))
+             for path in marker.args]
+    if paths:
+        _load_seeds(request, _db, transaction, request.getfixturevalue('_seed_cache'), paths)
+
+
+@pytest.fixture(scope='function')
+def db_seed(request, _db, _transaction, _seed_cache):
+    '''
+    Return a function that inserts the rows in JSON, YAML or CSV seed files
+    into the database, inside the test's transaction, and returns the number of
+    rows inserted into each table.
+    '''
+    def seed(*paths):
+        return _load_seeds(request, _db, _transaction, _seed_cache, paths)
+
+    return seed
+
+
+def _bind_engines(_db):
+    '''
+    Return the engines of the binds that the app configures besides the default
+    one, keyed by their bind key.
+    '''
+    if hasattr(_db, 'engines'):
+        return {key: engine for key, engine in _db.engines.items() if key is not None}
+
+    app = _db.get_app()
+    return {key: _db.get_engine(app, bind=key)
+            for key in app.config.get('SQLALCHEMY_BINDS') or ()}
+
+
+def _rollback_to_savepoint(connection, savepoint):
+    '''
+    Roll back a pinned connection to the SAVEPOINT that isolates the current test.
+    '''
+    # The session opens its own savepoints on top of the test's one. Since
+    # SQLAlchemy 1.4 the connection tracks them as a stack, so unwind it from
+    # the top to keep that stack in step with the database
+    if hasattr(connection, 'get_nested_transaction'):
+        nested = connection.get_nested_transaction()
+        while nested is not None and nested is not savepoint:
+            nested.rollback()
+            nested = connection.get_nested_transaction()
+
+    if savepoint.is_active:
+        savepoint.rollback()
+
+
+@pytest.fixture(scope='session')
+def _isolation_snapshots(request):
+    '''
+    Keep track of the snapshots taken by the `template` isolation strategy, and
+    drop them at the end of the test session.
+    '''
+    snapshots = set()
+
+    @request.addfinalizer
+    def drop_snapshots():
+        for url in snapshots:
+            databases.drop_database(url)
+
+    return snapshots
+
+
+@pytest.fixture(scope='function')
+def _isolation(pytestconfig, request, _db, _background_teardown):
+    '''
+    Set up the strategy that isolates a test's changes to the database, which
+    is picked with the `isolation` marker or the `isolation` option.
+    '''
+    marker = request.node.get_closest_marker('isolation')
+    name = marker.args[0] if marker is not None else pytestconfig._isolation
+
+    try:
+        strategy = isolation.get_strategy(name)
+    except ValueError as e:
+        pytest.fail(str(e), pytrace=False)
+
+    # Strategies that rebuild the database need every transaction that was
+    # handed to the background threads to be over, this test's included
+    wait = _background_teardown is not None and not strategy.transactional
+    if wait:
+        _background_teardown.wait()
+
+    try:
+        strategy.setup(request, _db)
+    except ValueError as e:
+        pytest.fail(str(e), pytrace=False)
+
+    @request.addfinalizer
+    def teardown_isolation():
+        if wait:
+            _background_teardown.wait()
+
+        try:
+            strategy.teardown(request, _db)
+        except ValueError as e:
+            pytest.fail(str(e), pytrace=False)
+
+    return strategy
+
+
+@pytest.fixture(scope='session')
+def _session_factory(pytestconfig):
+    '''
+    Create the factory of the session that gets rebound to each test's transaction.
+    '''
+    return SessionFactory(expire_on_commit=pytestconfig._expire_on_commit)
+
+
+@pytest.fixture(scope='function')
+def _transaction(pytestconfig, request, _db, _isolation, _session_factory, _background_teardown,
+                 _reference_cache):
+    '''
+    Create a transactional context for tests to run in. The connection,
+    transaction and session are only opened once the test first uses them.
+    '''
+    if not _isolation.transactional:
+        # The test commits for real, and its isolation strategy resets the
+        # database once it's done
+        if pytestconfig._sqla_profiler is not None:
+            profile = profiling.get_profile(request.node)
+            profile.watch(_db.engine)
+            request.addfinalizer(lambda: profile.unwatch(_db.engine))
+
+        _load_seed_markers(request, _db, None)
+
+        return None
+
+    # Run the test on the connection of the innermost layer it uses, if any.
+    # Pinned connections are opened ahead of the test anyway, so there's
+    # nothing to gain by resolving them lazily
+    pinned = None
+    if '_class_connection' in request.fixturenames:
+        pinned = request.getfixturevalue('_class_connection')
+    elif '_module_connection' in request.fixturenames:
+        pinned = request.getfixturevalue('_module_connection')
+    elif pytestconfig._reuse_connection:
+        pinned = request.getfixturevalue('_connection')
+
+    profile = None
+    if pytestconfig._sqla_profiler is not None:
+        profile = profiling.get_profile(request.node)
+
+    # Keep an eye on savepoints and leaks when a threshold is set for them, or
+    # when they'll end up in the profile
+    diagnosis = None
+    thresholds = pytestconfig._diagnostic_thresholds
+    if profile is not None or any(value is not None for value in thresholds.values()):
+        diagnosis = diagnostics.ConnectionDiagnostics(request.node.nodeid)
+
+    # Code under test that runs in several threads shares the connection, which
+    # can only run one statement at a time
+    lock = None
+    if pytestconfig._thread_safe_connection or 'db_connection_lock' in request.fixturenames:
+        lock = locking.ConnectionLock()
+
+    # Look up the engines now, since Flask-SQLAlchemy can only find them within
+    # an app context, which threads that open the connection may not have
+    engine = _db.engine
+    bind_engines = _bind_engines(_db)
+
+    # Registering the listeners that make savepoints and locking work is cheap,
+    # and doing it up front keeps them from showing up as leaked by the test
+    for engine_to_enable in [engine] + list(bind_engines.values()):
+        dialects.enable_savepoints(engine_to_enable)
+        if lock is not None:
+            locking.enable_serializing(engine_to_enable)
+
+    test_savepoint = None
+    restore_connection = None
+
+    def open_connection(engine):
+        # Start a transaction
+        connection = engine.connect()
+        transaction = connection.begin()
+
+        if profile is not None:
+            profile.watch(connection)
+
+        if lock is not None:
+            locking.serialize(connection, lock)
+
+        # Make sure the connection and transaction can't be closed by accident in
+        # the codebase
+        connection.force_close = connection.close
+        connection.close = lambda: None
+
+        # Force the connection to use nested transactions, whether or not the
+        # test ends up using the session
+        connection.begin = connection.begin_nested
+
+        if not JOIN_EXTERNAL_TRANSACTIONS:
+            transaction.force_rollback = transaction.rollback
+            transaction.rollback = lambda: None
+
+        return connection, transaction
+
     def begin():
-        '''
-        Open a new nested transaction on the `connection` object.
-        '''
-        with connection.begin_nested():
-            yield connection
+        nonlocal test_savepoint, restore_connection
 
-    # Force the engine object to use the current connection and transaction
-    engine.begin = begin
-    engine.execute = connection.execute
+        if pinned is None:
+            return open_connection(engine)
 
-    # Enforce nested transactions for raw DBAPI connections
-    def raw_connection():
-        # Start a savepoint
-        connection.execute('''SAVEPOINT raw_conn''')
+        # Isolate the test inside a SAVEPOINT on the pinned connection, so
+        # that teardown only needs to roll back to it
+        connection, transaction = pinned
+        test_savepoint = connection.begin_nested()
 
-        # Preserve close/commit/rollback methods
-        connection.connection.force_close = connection.connection.close
-        connection.connection.force_commit = connection.connection.commit
-        connection.connection.force_rollback = connection.connection.rollback
+        if profile is not None:
+            profile.watch(connection)
 
-        # Prevent the connection from being closed accidentally
-        connection.connection.close = lambda: None
-        connection.connection.commit = lambda: None
-        connection.connection.set_isolation_level = lambda level: None
+        if lock is not None:
+            restore_connection = locking.serialize(connection, lock)
 
-        # If a rollback is initiated, return to the original savepoint
-        connection.connection.rollback = lambda: connection.execute('''ROLLBACK TO SAVEPOINT raw_conn''')
+        return connection, transaction
 
-        return connection.connection
+    def begin_bind(engine):
+        def begin():
+            return open_connection(engine)
 
-    engine.raw_connection = raw_connection
+        return begin
 
-    for mocked_engine in pytestconfig._mocked_engines:
-        mocker.patch(mocked_engine, new=engine)
+    transaction = LazyTransaction(begin, lock=lock)
 
-    session.bind = engine
+    # Each of the app's other binds gets its own connection and transaction,
+    # opened once the session first looks it up
+    for key, bind_engine in bind_engines.items():
+        transaction.binds[key] = LazyTransaction(begin_bind(bind_engine), lock=lock)
+
+    # Rebind the session that was built for an earlier test, if there was one
+    transaction.session = _session_factory.bind(_db, transaction, profile=profile,
+                                                reference=_reference_cache)
+
+    if diagnosis is not None:
+        for lazy_transaction in [transaction] + list(transaction.binds.values()):
+            lazy_transaction.on_open(diagnosis.watch)
+
+        # The objects that outlive the test, which it shouldn't leave any
+        # listeners on
+        diagnosis.track_listeners([engine, transaction.session, getattr(_db, 'session', None)] +
+                                  list(bind_engines.values()) +
+                                  [pinned[0] if pinned is not None else None])
+
+        # Finalizers run in reverse order, so this one runs once the
+        # transaction has been torn down
+        @request.addfinalizer
+        def check_diagnostics():
+            diagnosis.check_listeners()
+            diagnosis.check_registries([transaction.session, getattr(_db, 'session', None)])
+            diagnosis.warn(thresholds)
+
+            if profile is not None:
+                profile.diagnostics = diagnosis.as_dict()
+
+    # Leave the rollbacks to the background threads, if there are any
+    release = (teardown.release_connection if _background_teardown is None else
+               _background_teardown.release)
+
+    @request.addfinalizer
+    def teardown_transaction():
+        if not transaction.is_open:
+            # The test never used the database
+            _session_factory.reset()
+            return
+
+        connection, outer_transaction = transaction.open()
+
+        if profile is not None:
+            profile.unwatch(connection)
+
+        if diagnosis is not None:
+            diagnosis.unwatch(connection)
+
+        if test_savepoint is not None:
+            # Roll back before removing the session, since closing the session
+            # would otherwise roll back its own savepoints out of order. Keep
+            # the pinned connection open for the next test
+            _rollback_to_savepoint(connection, test_savepoint)
+            _session_factory.reset()
+
+            if restore_connection is not None:
+                restore_connection()
+        else:
+            # Delete the session
+            _session_factory.reset()
+
+            # Rollback the transaction and return the connection to the pool
+            release(connection, outer_transaction)
+
+        # Do the same for the binds that the test used
+        for bind in transaction.binds.values():
+            if bind.is_open:
+                bind_connection, bind_transaction = bind.open()
+
+                if profile is not None:
+                    profile.unwatch(bind_connection)
+
+                if diagnosis is not None:
+                    diagnosis.unwatch(bind_connection)
+
+                release(bind_connection, bind_transaction)
+
+    _load_seed_markers(request, _db, transaction)
+
+    return transaction
+
+
+@pytest.fixture(scope='session')
+def _engine_proxy():
+    '''
+    Create the Engine stand-in that gets rebound to each test's connection.
+    '''
+    return TransactionalEngine()
+
+
+@pytest.fixture(scope='function')
+def _engine(pytestconfig, request, _db, _transaction, _engine_proxy):
+    '''
+    Mock out direct access to the semi-global Engine object.
+    '''
+    if _transaction is None:
+        return _db.engine
+
+    session = _transaction.session
+
+    # Force the engine object to use the current connection and transaction,
+    # once the test first needs it. The session factory registers the engine
+    # alongside the connection whenever the session begins a transaction on it
+    engine = _engine_proxy
+    engine.transaction = _transaction
+
+    _transaction.session_bind = engine
+    if session.registry.has():
+        session.bind = engine
+
+    # Swap out the configured engines, which were imported at startup
+    restore_engines = install_targets(pytestconfig._mocked_engines, engine)
+    request.addfinalizer(restore_engines)
 
     @request.addfinalizer
-    def reset_raw_connection():
-        # Return the underlying connection to its original state if it has changed
-        if hasattr(connection.connection, 'force_rollback'):
-            connection.connection.commit = connection.connection.force_commit
-            connection.connection.rollback = connection.connection.force_rollback
-            connection.connection.close = connection.connection.force_close
+    def release_connection():
+        # Don't hold on to the connection, or the raw connections checked out
+        # from it, once the test is over
+        engine.connection = None
+        engine.transaction = None
 
     return engine
 
 
+@pytest.fixture(scope='session')
+def _sessionmaker_proxy():
+    '''
+    Create the sessionmaker stand-in that gets rebound to each test's session.
+    '''
+    return FakeSessionMaker()
+
+
 @pytest.fixture(scope='function')
-def _session(pytestconfig, _transaction, mocker):
+def _session(pytestconfig, request, _db, _transaction, _sessionmaker_proxy):
     '''
     Mock out Session objects (a common way of interacting with the database using
     the SQLAlchemy ORM) using a transactional context.
     '''
-    _, _, session = _transaction
+    if _transaction is None:
+        # Return the connection to the pool before the database gets reset
+        request.addfinalizer(_db.session.remove)
+        return _db.session
+
+    session = _transaction.session
 
     # Whenever the code tries to access a Flask session, use the Session object
     # instead
-    for mocked_session in pytestconfig._mocked_sessions:
-        mocker.patch(mocked_session, new=session)
+    restore_sessions = install_targets(pytestconfig._mocked_sessions, session)
 
-    # Create a dummy class to mock out the sessionmakers
-    # (We need to do this as a class because we can't mock __call__ methods)
-    class FakeSessionMaker(sa.orm.Session):
-        def __call__(self):
-            return session
+    # Mock out the WorkerSession
+    sessionmaker = _sessionmaker_proxy
+    sessionmaker.session = session
+    restore_sessionmakers = install_targets(pytestconfig._mocked_sessionmakers, sessionmaker)
 
-        @classmethod
-        def configure(cls, *args, **kwargs):
-            pass
+    @request.addfinalizer
+    def restore_mocked_sessions():
+        restore_sessionmakers()
+        restore_sessions()
 
-    # Mock out the WorkerSession
-    for mocked_sessionmaker in pytestconfig._mocked_sessionmakers:
-        mocker.patch(mocked_sessionmaker, new_callable=FakeSessionMaker)
+        # Don't hold on to the session once the test is over
+        sessionmaker.session = None
 
     return session
 
@@ -214,3 +861,46 @@ def db_engine(_engine, _session, _transaction):
     SQLAlchemy Engine API.
     '''
     return _engine
+
+
+@pytest.fixture(scope='function')
+def db_query_counter(request, _db, _transaction):
+    '''
+    Count the queries executed on the transactional connection while the test
+    runs. Queries executed while setting up other fixtures aren't counted.
+    '''
+    counter = profiling.QueryCounter()
+    if _transaction is None:
+        counter.watch(_db.engine)
+    else:
+        for transaction in [_transaction] + list(_transaction.binds.values()):
+            transaction.on_open(counter.watch)
+
+    # Let the plugin reset the counter when the test starts, and check the
+    # `max_queries` marker when it ends
+    request.node._sqla_query_counter = counter
+
+    @request.addfinalizer
+    def stop_counting():
+        if _transaction is None:
+            counter.unwatch(_db.engine)
+        else:
+            for transaction in [_transaction] + list(_transaction.binds.values()):
+                if transaction.is_open:
+                    counter.unwatch(transaction.connection)
+        request.node._sqla_query_counter = None
+
+    return counter
+
+
+@pytest.fixture(scope='function')
+def db_connection_lock(_transaction):
+    '''
+    Serialise the threads that share the transactional connection, and report
+    how long they had to wait for each other.
+    '''
+    if _transaction is None:
+        pytest.fail('db_connection_lock requires the rollback isolation strategy',
+                    pytrace=False)
+
+    return _transaction.lock
@@ -0,0 +1,169 @@
+import re
+
+import sqlalchemy as sa
+
+from . import databases
+
+
+# A table name, which may be quoted and qualified with a schema
+_TABLE_NAME = r'(?:"[^"]+"|`[^`]+`|\[[^\]]+\]|\w+)(?:\.(?:"[^"]+"|`[^`]+`|\[[^\]]+\]|\w+))?'
+
+# Statements that write to a table, and the name of that table
+WRITE_STATEMENT = re.compile(r'^\s*(?:INSERT\s+(?:OR\s+\w+\s+)?INTO|REPLACE\s+INTO|UPDATE|' +
+                             r'DELETE\s+FROM)\s+(?:ONLY\s+)?(' + _TABLE_NAME + ')',
+                             re.IGNORECASE)
+
+
+def _unquote(name):
+    return '.'.join(part.strip('"`[]') for part in name.split('.'))
+
+
+def dependent_tables(metadata, names):
+    '''
+    Return the tables of `metadata` that are called one of `names`, along with
+    every table that refers to them through foreign keys, directly or through
+    other tables, each table after the ones that it depends on.
+    '''
+    tables = {table for table in metadata.sorted_tables
+              if table.name in names or table.fullname in names}
+
+    # Foreign keys that form a cycle can leave a table sorted ahead of one that
+    # it refers to, so keep going until no more tables turn up
+    found = True
+    while found:
+        found = False
+        for table in metadata.sorted_tables:
+            if table not in tables and any(constraint.referred_table in tables
+                                           for constraint in table.foreign_key_constraints):
+                tables.add(table)
+                found = True
+
+    return [table for table in metadata.sorted_tables if table in tables]
+
+
+class IsolationStrategy(object):
+    '''
+    A way of undoing the changes that a test makes to the database, picked for
+    each test with the `isolation` marker.
+
+    Transactional strategies hand the test connections that are isolated by a
+    transaction. The others let the test commit for real through the `_db`
+    engine, and reset the database in `teardown` instead.
+    '''
+    name = None
+    transactional = False
+
+    def setup(self, request, _db):
+        pass
+
+    def teardown(self, request, _db):
+        pass
+
+
+class RollbackIsolation(IsolationStrategy):
+    '''
+    Run the test inside a transaction that gets rolled back once it's done.
+    This is the cheapest strategy, but it only isolates the changes made through
+    the connections and sessions that the plugin hands out.
+    '''
+    name = 'rollback'
+    transactional = True
+
+
+class TruncateIsolation(IsolationStrategy):
+    '''
+    Record the tables that the test writes to through any connection of the
+    `_db` engine, and empty only those tables once it's done.
+    '''
+    name = 'truncate'
+
+    def __init__(self):
+        self.engine = None
+        self.tables = set()
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        match = WRITE_STATEMENT.match(statement)
+        if match:
+            self.tables.add(_unquote(match.group(1)))
+
+    def setup(self, request, _db):
+        self.engine = _db.engine
+        sa.event.listen(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+
+    def teardown(self, request, _db):
+        sa.event.remove(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        if not self.tables:
+            return
+
+        # Rows of other tables can refer to the rows that get emptied, so empty
+        # every table that depends on the written ones too, those that depend on
+        # others first, followed by any tables that the metadata doesn't know about
+        tables = list(reversed(dependent_tables(_db.metadata, self.tables)))
+        known = {table.fullname for table in tables} | {table.name for table in tables}
+        for name in sorted(self.tables - known):
+            schema_name, _, table_name = name.rpartition('.')
+            tables.append(sa.table(table_name, schema=schema_name or None))
+
+        with self.engine.begin() as connection:
+            if connection.dialect.name == 'postgresql':
+                # A single TRUNCATE takes care of foreign keys between the tables,
+                # and fails rather than cascade to tables outside the metadata
+                preparer = connection.dialect.identifier_preparer
+                connection.execute(sa.text('TRUNCATE TABLE {}'.format(
+                    ', '.join(preparer.format_table(table) for table in tables))))
+            else:
+                for table in tables:
+                    connection.execute(table.delete())
+
+
+class TemplateIsolation(IsolationStrategy):
+    '''
+    Take a snapshot of the whole database before the test, and restore the
+    database from it once the test is done. The snapshot is taken again for
+    every test, since fixtures may have committed data since the last one.
+    '''
+    name = 'template'
+
+    def _check_connections(self, engine):
+        # Copying a database requires that nothing is connected to it, and the
+        # connections that outlive a test can't be closed from under it
+        checkedout = getattr(engine.pool, 'checkedout', None)
+        if checkedout is not None and checkedout():
+            raise ValueError('The template isolation strategy can\'t copy the database while '
+                             'other connections to it are open ({} checked out), such as the '
+                             'ones kept open by the reuse-connection option, '
+                             'db_session_module, db_session_class and '
+                             'db_session_readonly'.format(checkedout()))
+
+    def setup(self, request, _db):
+        snapshots = request.getfixturevalue('_isolation_snapshots')
+        self._check_connections(_db.engine)
+
+        url = _db.engine.url
+        self.snapshot_url = databases.suffixed_url(url, 'snapshot')
+
+        # Copying a database requires that nothing is connected to it
+        _db.engine.dispose()
+        databases.create_database(self.snapshot_url, template=url)
+        snapshots.add(self.snapshot_url)
+
+    def teardown(self, request, _db):
+        engine = _db.engine
+        self._check_connections(engine)
+        engine.dispose()
+        databases.create_database(engine.url, template=self.snapshot_url)
+
+
+STRATEGIES = {strategy.name: strategy
+              for strategy in (RollbackIsolation, TruncateIsolation, TemplateIsolation)}
+
+
+def get_strategy(name):
+    '''
+    Create an instance of the isolation strategy called `name`.
+    '''
+    try:
+        return STRATEGIES[name]()
+    except KeyError:
+        raise ValueError('Unknown isolation strategy {!r} (expected one of: {})'.format(
+            name, ', '.join(sorted(STRATEGIES))))
@@ -0,0 +1,145 @@
+import functools
+import threading
+import time
+
+import sqlalchemy as sa
+
+
+# The methods of DBAPI cursors that run statements, including psycopg2's COPY
+LOCKED_CURSOR_METHODS = ('execute', 'executemany', 'callproc',
+                         'copy_from', 'copy_to', 'copy_expert')
+
+
+class ConnectionLock(object):
+    '''
+    A re-entrant lock that serialises the threads sharing a test's connection,
+    and records how long they had to wait for each other.
+    '''
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._threads = set()
+
+        self.acquisitions = 0
+        self.contentions = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def __repr__(self):
+        return '<ConnectionLock acquisitions={} contentions={}>'.format(self.acquisitions,
+                                                                       self.contentions)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    @property
+    def threads(self):
+        '''
+        The number of threads that have used the connection.
+        '''
+        return len(self._threads)
+
+    def acquire(self):
+        depth = getattr(self._local, 'depth', 0)
+
+        # A free lock, or one that this thread already holds, is taken
+        # without waiting
+        if not self._lock.acquire(blocking=False):
+            start = time.perf_counter()
+            self._lock.acquire()
+            waited = time.perf_counter() - start
+
+            self.contentions += 1
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+
+        # Only count the outermost acquisition of each thread. The counters
+        # are safe to update, since this thread holds the lock
+        self._local.depth = depth + 1
+        if depth == 0:
+            self.acquisitions += 1
+            self._threads.add(threading.get_ident())
+
+    def release(self):
+        self._local.depth -= 1
+        self._lock.release()
+
+    def as_dict(self):
+        return {
+            'acquisitions': self.acquisitions,
+            'contentions': self.contentions,
+            'wait_time': self.wait_time,
+            'max_wait': self.max_wait,
+            'threads': self.threads,
+        }
+
+
+def locked(method, lock):
+    '''
+    Wrap `method` so that it holds `lock` while it runs.
+    '''
+    @functools.wraps(method)
+    def locked_method(*args, **kwargs):
+        with lock:
+            return method(*args, **kwargs)
+
+    return locked_method
+
+
+def _release_failed_statement(exception_context):
+    release = getattr(exception_context.connection, 'release_statement_lock', None)
+    if release is not None:
+        release()
+
+
+def enable_serializing(engine):
+    '''
+    Let connections of `engine` that are serialised give up their lock when a
+    statement fails. SQLAlchemy 2.0 only lets `handle_error` listen on a whole
+    engine, so the listener finds the lock through the connection that failed.
+    '''
+    if not sa.event.contains(engine, 'handle_error', _release_failed_statement):
+        sa.event.listen(engine, 'handle_error', _release_failed_statement)
+
+
+def serialize(connection, lock):
+    '''
+    Make each thread hold `lock` while it runs a statement on `connection`,
+    which includes the statements that begin and end SAVEPOINTs. Return a
+    function that undoes it.
+    '''
+    # The statements that each thread is running, which have to release the
+    # lock if they fail
+    local = threading.local()
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        lock.acquire()
+        local.statements = getattr(local, 'statements', 0) + 1
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        local.statements -= 1
+        lock.release()
+
+    def release_statement_lock():
+        if getattr(local, 'statements', 0):
+            local.statements -= 1
+            lock.release()
+
+    listeners = [('before_cursor_execute', before_cursor_execute),
+                 ('after_cursor_execute', after_cursor_execute)]
+    for name, listener in listeners:
+        sa.event.listen(connection, name, listener)
+
+    connection.release_statement_lock = release_statement_lock
+    enable_serializing(connection.engine)
+
+    def restore():
+        for name, listener in listeners:
+            sa.event.remove(connection, name, listener)
+        del connection.release_statement_lock
+
+    return restore
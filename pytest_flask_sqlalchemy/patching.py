@@ -0,0 +1,76 @@
+import importlib
+
+
+def _import_object(path):
+    '''
+    Import the object referenced by a standard Python import path, importing
+    any intermediate modules along the way.
+    '''
+    components = path.split('.')
+    imported = components[0]
+    obj = importlib.import_module(imported)
+
+    for component in components[1:]:
+        imported += '.' + component
+        try:
+            obj = getattr(obj, component)
+        except AttributeError:
+            importlib.import_module(imported)
+            obj = getattr(obj, component)
+
+    return obj
+
+
+class MockedTarget(object):
+    '''
+    An object configured by one of the `mocked-*` options. The import path is
+    resolved once, when pytest starts, so that tests only need to swap an
+    attribute on an object that has already been looked up.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+        if '.' not in path:
+            raise ValueError('{} could not be imported: it has no attribute to '
+                             'replace'.format(path))
+
+        parent_path, self.attribute = path.rsplit('.', 1)
+        try:
+            self.parent = _import_object(parent_path)
+        except (ImportError, AttributeError) as e:
+            # Keep the real cause, which may be a failing import inside the
+            # user's own module rather than a typo in the path
+            raise ValueError('{} could not be imported: {}: {}'.format(
+                path, type(e).__name__, e))
+
+        if not hasattr(self.parent, self.attribute):
+            raise ValueError('{} could not be imported: {!r} has no attribute {!r}'.format(
+                path, parent_path, self.attribute))
+
+    def __repr__(self):
+        return '<MockedTarget {}>'.format(self.path)
+
+    def install(self, new):
+        '''
+        Replace the target with `new` and return the object it replaced.
+        '''
+        original = getattr(self.parent, self.attribute)
+        setattr(self.parent, self.attribute, new)
+        return original
+
+    def restore(self, original):
+        setattr(self.parent, self.attribute, original)
+
+
+def install_targets(targets, new):
+    '''
+    Replace each of a list of targets with `new`, and return a function that puts
+    the original objects back.
+    '''
+    originals = [(target, target.install(new)) for target in targets]
+
+    def restore():
+        for target, original in reversed(originals):
+            target.restore(original)
+
+    return restore
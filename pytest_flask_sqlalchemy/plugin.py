@@ -1,10 +1,53 @@
-from .fixtures import _db, _transaction, _engine, _session, db_session, db_engine
+import pytest
+
+from .diagnostics import THRESHOLDS
+from .isolation import STRATEGIES
+from .patching import MockedTarget
+from .profiling import Profiler
+from .fixtures import (_db, _schema_cache, db_create_all, _worker_database, _connection,
+                       _module_connection, _class_connection, db_session_module,
+                       db_session_class, _readonly_snapshot, db_session_readonly,
+                       _background_teardown, db_reference_models, _reference_cache,
+                       _seed_cache, db_seed,
+                       _isolation_snapshots, _isolation,
+                       _session_factory, _transaction, _engine_proxy, _engine,
+                       _sessionmaker_proxy, _session,
+                       db_session, db_engine, db_query_counter, db_connection_lock)
+
+try:
+    # The async fixtures need SQLAlchemy's asyncio extension and pytest-asyncio,
+    # which are optional dependencies
+    from .async_fixtures import (_async_db, _async_transaction, _async_engine_proxy,
+                                 _async_engine, _async_session, async_db_session,
+                                 async_db_engine)
+except ImportError:
+    pass
 
 
 def pytest_addoption(parser):
     '''
     Add additional command-line args.
     '''
+    group = parser.getgroup('flask-sqlalchemy')
+    group.addoption('--sqla-profile',
+                    action='store_true',
+                    default=False,
+                    help=('Profile the database work done in each test that uses ' +
+                          'the transactional fixtures, and report the slowest ' +
+                          'tests and heaviest queries.'))
+    group.addoption('--sqla-profile-json',
+                    metavar='PATH',
+                    default=None,
+                    help=('Write the database profile of each test to a JSON file ' +
+                          '(implies --sqla-profile).'))
+    group.addoption('--sqla-explain',
+                    metavar='SECONDS',
+                    type=float,
+                    default=None,
+                    help=('Record the query plan of each statement that takes at ' +
+                          'least SECONDS to run on the transactional connection, and ' +
+                          'report the plans of the slowest ones (implies --sqla-profile).'))
+
     base_msg = ('A whitespace-separated list of {obj} objects that should ' +
                 'be mocked and replaced with a transactional equivalent. ' +
                 'Each instance should be formatted as a standard ' +
@@ -23,11 +66,222 @@ def pytest_addoption(parser):
                   type='args',
                   help=base_msg.format(obj='SQLAlchemy Sessionmaker'))
 
+    parser.addini('mocked-async-engines',
+                  type='args',
+                  help=base_msg.format(obj='SQLAlchemy AsyncEngine'))
+
+    parser.addini('mocked-async-sessions',
+                  type='args',
+                  help=base_msg.format(obj='SQLAlchemy AsyncSession'))
+
+    parser.addini('reuse-connection',
+                  type='bool',
+                  default=False,
+                  help=('Keep one database connection open for the whole test ' +
+                        'session (one per pytest-xdist worker) and isolate each ' +
+                        'test with a SAVEPOINT on it, instead of opening and ' +
+                        'closing a connection for every test.'))
+
+    parser.addini('thread-safe-connection',
+                  type='bool',
+                  default=False,
+                  help=('Serialise the statements that threads in the code under ' +
+                        'test run on the shared transactional connection, so that ' +
+                        'they take turns instead of corrupting it.'))
+
+    parser.addini('expire-on-commit',
+                  default='all',
+                  help=('Which objects in the db_session identity map to expire ' +
+                        'when the code under test commits: "all" of them (the ' +
+                        'default), only the ones that were "modified" since the ' +
+                        'last commit, or "none".'))
+
+    parser.addini('isolation',
+                  default='rollback',
+                  help=('The strategy that isolates the changes each test makes to ' +
+                        'the database, unless the test picks another one with the ' +
+                        'isolation marker: {}.'.format(', '.join(sorted(STRATEGIES)))))
+
+    parser.addini('xdist-databases',
+                  type='bool',
+                  default=False,
+                  help=('When running tests with pytest-xdist, give each worker ' +
+                        'its own database, cloned from a template database that ' +
+                        'is built once per test run.'))
+
+    parser.addini('schema-cache',
+                  type='bool',
+                  default=False,
+                  help=('Fingerprint the metadata of the _db fixture and skip ' +
+                        'building the schema of a test or template database when ' +
+                        'it was already built from the same metadata.'))
+
+    threshold_msg = ('Warn about tests that {} (unset by default, which turns the ' +
+                     'warning off).')
+
+    parser.addini('warn-savepoint-depth',
+                  help=threshold_msg.format('have more than this many savepoints open ' +
+                                            'at once on their connection'))
+
+    parser.addini('warn-savepoints',
+                  help=threshold_msg.format('open more than this many savepoints'))
+
+    parser.addini('warn-leaked-listeners',
+                  help=threshold_msg.format('leave more than this many event listeners ' +
+                                            'attached to the engines, connections and ' +
+                                            'sessions that outlive them'))
+
+    parser.addini('warn-registry-objects',
+                  help=threshold_msg.format('leave more than this many objects in the ' +
+                                            'sessions of the scoped-session registries'))
+
+    parser.addini('background-teardown',
+                  help=('Roll back the transactions of finished tests and return ' +
+                        'their connections to the pool in background threads, with ' +
+                        'up to this many connections being released at once (unset ' +
+                        'by default, which releases them before the next test starts).'))
+
+
+EXPIRE_ON_COMMIT_POLICIES = ('all', 'modified', 'none')
+
+
+def _resolve_count(config, name):
+    '''
+    Parse the whole number set by an ini option, if any.
+    '''
+    value = config.getini(name)
+    if not value:
+        return None
+
+    try:
+        count = int(value)
+    except ValueError:
+        count = -1
+
+    if count < 0:
+        raise pytest.UsageError('Invalid {} option: {!r} (expected a whole number that is '
+                                'at least 0)'.format(name, value))
+
+    return count
+
+
+def _resolve_mocked_targets(config, name):
+    '''
+    Import each of the paths listed in the `name` ini option.
+    '''
+    targets = []
+    for path in config.getini(name):
+        try:
+            targets.append(MockedTarget(path))
+        except ValueError as e:
+            raise pytest.UsageError('Invalid {} option: {}'.format(name, e))
+
+    return targets
+
 
 def pytest_configure(config):
     '''
     Add transactional options to pytest's configuration.
     '''
-    config._mocked_engines = config.getini('mocked-engines')
-    config._mocked_sessions = config.getini('mocked-sessions')
-    config._mocked_sessionmakers = config.getini('mocked-sessionmakers')
+    # Resolve the objects to mock once, up front, so that a bad import path
+    # fails the run immediately instead of every test that uses the fixtures
+    config._mocked_engines = _resolve_mocked_targets(config, 'mocked-engines')
+    config._mocked_sessions = _resolve_mocked_targets(config, 'mocked-sessions')
+    config._mocked_sessionmakers = _resolve_mocked_targets(config, 'mocked-sessionmakers')
+    config._mocked_async_engines = _resolve_mocked_targets(config, 'mocked-async-engines')
+    config._mocked_async_sessions = _resolve_mocked_targets(config, 'mocked-async-sessions')
+    config._reuse_connection = config.getini('reuse-connection')
+    config._thread_safe_connection = config.getini('thread-safe-connection')
+
+    config._expire_on_commit = config.getini('expire-on-commit')
+    if config._expire_on_commit not in EXPIRE_ON_COMMIT_POLICIES:
+        raise pytest.UsageError('Invalid expire-on-commit option: {!r} (expected one of: {})'
+                                .format(config._expire_on_commit,
+                                        ', '.join(EXPIRE_ON_COMMIT_POLICIES)))
+
+    config._isolation = config.getini('isolation')
+    if config._isolation not in STRATEGIES:
+        raise pytest.UsageError('Invalid isolation option: {!r} (expected one of: {})'
+                                .format(config._isolation, ', '.join(sorted(STRATEGIES))))
+
+    config._xdist_databases = config.getini('xdist-databases')
+    config._schema_cache = config.getini('schema-cache')
+    config._diagnostic_thresholds = {name: _resolve_count(config, name)
+                                     for name in THRESHOLDS}
+    config._background_teardown = _resolve_count(config, 'background-teardown') or None
+
+    config.addinivalue_line('markers',
+                            'max_queries(n, max_repeats=None): fail the test if it ' +
+                            'executes more than n queries, or executes the same ' +
+                            'statement with different parameters more than ' +
+                            'max_repeats times.')
+    config.addinivalue_line('markers',
+                            'isolation(strategy): isolate the changes the test makes ' +
+                            'to the database with the given strategy: ' +
+                            ', '.join(sorted(STRATEGIES)) + '.')
+    config.addinivalue_line('markers',
+                            'seed(*paths): insert the rows in the given JSON, YAML or ' +
+                            'CSV seed files, relative to the test module, into the ' +
+                            'database before the test runs.')
+
+    explain_threshold = config.getoption('sqla_explain')
+    if explain_threshold is not None and explain_threshold < 0:
+        raise pytest.UsageError('Invalid --sqla-explain option: {} (expected a number of '
+                                'seconds that is at least 0)'.format(explain_threshold))
+
+    config._sqla_profiler = None
+    json_path = config.getoption('sqla_profile_json')
+    if config.getoption('sqla_profile') or json_path or explain_threshold is not None:
+        config._sqla_profiler = Profiler(config, json_path=json_path,
+                                         explain_threshold=explain_threshold)
+        config.pluginmanager.register(config._sqla_profiler, 'sqla-profiler')
+
+
+def pytest_collection_modifyitems(session, config, items):
+    '''
+    Count the queries of tests marked with `max_queries`, without setting up a
+    fixture for every other test.
+    '''
+    for item in items:
+        if (item.get_closest_marker('max_queries') is not None and
+                'db_query_counter' not in item.fixturenames):
+            item.fixturenames.append('db_query_counter')
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_runtest_setup(item):
+    '''
+    Fixtures have been set up by now, so reset any query counter to only count
+    the queries executed by the test itself.
+    '''
+    counter = getattr(item, '_sqla_query_counter', None)
+    if counter is not None:
+        counter.reset()
+
+
+@pytest.hookimpl(trylast=True)
+def pytest_runtest_call(item):
+    '''
+    Enforce the query budget of tests marked with `max_queries`.
+    '''
+    counter = getattr(item, '_sqla_query_counter', None)
+    marker = item.get_closest_marker('max_queries')
+    if counter is not None and marker is not None:
+        counter.check(*marker.args, **marker.kwargs)
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_runtest_teardown(item, nextitem):
+    '''
+    End the read-only snapshot of a test that used `db_session_readonly`, unless
+    the next test uses it too. This happens before any fixtures are torn down,
+    since the locks that the snapshot holds would block their schema changes.
+    '''
+    snapshot = getattr(item, '_sqla_readonly_snapshot', None)
+    if snapshot is None:
+        return
+
+    # Keep sharing the snapshot between the tests of the same module or class
+    if (nextitem is None or nextitem.parent is not item.parent or
+            'db_session_readonly' not in nextitem.fixturenames):
+        snapshot.release()
@@ -0,0 +1,341 @@
+import functools
+import json
+import re
+import time
+
+import pytest
+import sqlalchemy as sa
+
+from . import dialects
+
+
+# Function-scoped plugin fixtures whose setup and teardown time gets profiled
+PROFILED_FIXTURES = {'_transaction', '_engine', '_session', 'db_session', 'db_engine',
+                     '_async_transaction', '_async_engine', '_async_session',
+                     'async_db_session', 'async_db_engine'}
+
+
+class DatabaseProfile(object):
+    '''
+    Record what a single test does with the database: the statements it runs on
+    the transactional connection, and the work the plugin's fixtures do for it.
+
+    Statements that take at least `explain_threshold` seconds also get their
+    query plan recorded.
+    '''
+    def __init__(self, nodeid, explain_threshold=None):
+        self.nodeid = nodeid
+        self.explain_threshold = explain_threshold
+        self.statements = 0
+        self.rows = 0
+        self.sql_time = 0.0
+        self.savepoints = 0
+        self.rehydrated = 0
+        self.setup_time = 0.0
+        self.teardown_time = 0.0
+
+        # Map statements to the number of times they ran and their total time
+        self.queries = {}
+
+        # The query plans of slow statements
+        self.plans = []
+
+        # What `ConnectionDiagnostics` found about the test's savepoints and leaks
+        self.diagnostics = None
+
+        self._statement_start = None
+        self._teardown_starts = {}
+        self._listeners = [
+            ('before_cursor_execute', self._before_cursor_execute),
+            ('after_cursor_execute', self._after_cursor_execute),
+        ]
+
+    def watch(self, connection):
+        '''
+        Start recording the statements executed on a connection.
+        '''
+        for name, listener in self._listeners:
+            sa.event.listen(connection, name, listener)
+
+    def unwatch(self, connection):
+        for name, listener in self._listeners:
+            if sa.event.contains(connection, name, listener):
+                sa.event.remove(connection, name, listener)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self._statement_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - self._statement_start
+
+        self.statements += 1
+        self.sql_time += elapsed
+
+        # Not every DBAPI reports a row count for SELECT statements
+        if cursor.rowcount > 0:
+            self.rows += cursor.rowcount
+
+        count, total = self.queries.get(statement, (0, 0.0))
+        self.queries[statement] = (count + 1, total + elapsed)
+
+        if (self.explain_threshold is not None and elapsed >= self.explain_threshold and
+                not executemany and EXPLAINABLE_STATEMENT.match(statement)):
+            plan = dialects.explain(conn, statement, parameters)
+            if plan:
+                self.plans.append({'statement': statement, 'time': elapsed, 'plan': plan})
+
+    def start_teardown(self, argname):
+        self._teardown_starts[argname] = time.perf_counter()
+
+    def end_teardown(self, argname):
+        start = self._teardown_starts.pop(argname, None)
+        if start is not None:
+            self.teardown_time += time.perf_counter() - start
+
+    def as_dict(self):
+        return {
+            'nodeid': self.nodeid,
+            'statements': self.statements,
+            'rows': self.rows,
+            'sql_time': self.sql_time,
+            'savepoints': self.savepoints,
+            'rehydrated': self.rehydrated,
+            'setup_time': self.setup_time,
+            'teardown_time': self.teardown_time,
+            'queries': [{'statement': statement, 'count': count, 'time': total}
+                        for statement, (count, total) in self.queries.items()],
+            'plans': self.plans,
+            'diagnostics': self.diagnostics,
+        }
+
+
+# Savepoint statements are bookkeeping done by the plugin and SQLAlchemy, rather
+# than queries made by the code under test
+SAVEPOINT_STATEMENT = re.compile(r'^\s*(SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT)\b',
+                                 re.IGNORECASE)
+
+# Statements that have a query plan to explain
+EXPLAINABLE_STATEMENT = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+
+
+class QueryCounter(object):
+    '''
+    Record the queries executed on a connection, in order to enforce query
+    budgets and spot the same statement running over and over with different
+    parameters (a sign of an N+1 query problem).
+    '''
+    def __init__(self):
+        self.queries = []
+
+        self._listener = self._after_cursor_execute
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    def watch(self, connection):
+        sa.event.listen(connection, 'after_cursor_execute', self._listener)
+
+    def unwatch(self, connection):
+        if sa.event.contains(connection, 'after_cursor_execute', self._listener):
+            sa.event.remove(connection, 'after_cursor_execute', self._listener)
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not SAVEPOINT_STATEMENT.match(statement):
+            self.queries.append((' '.join(statement.split()), parameters))
+
+    def reset(self):
+        self.queries = []
+
+    def repeated(self, min_count=2):
+        '''
+        Return the statements that ran at least `min_count` times with more than
+        one set of parameters, as a list of (statement, count) tuples.
+        '''
+        executions = {}
+        for statement, parameters in self.queries:
+            executions.setdefault(statement, []).append(repr(parameters))
+
+        return [(statement, len(parameters))
+                for statement, parameters in executions.items()
+                if len(parameters) >= min_count and len(set(parameters)) > 1]
+
+    def check(self, max_queries=None, max_repeats=None):
+        '''
+        Fail the current test if it ran more than `max_queries` queries, or ran
+        the same statement with different parameters more than `max_repeats` times.
+        '''
+        problems = []
+
+        if max_queries is not None and self.count > max_queries:
+            problems.append('{} queries were executed, but the limit is {}'.format(
+                self.count, max_queries))
+
+        if max_repeats is not None:
+            for statement, count in self.repeated(min_count=max_repeats + 1):
+                problems.append('Statement executed {} times with different parameters '
+                                '(limit {}): {}'.format(count, max_repeats, statement))
+
+        if problems:
+            lines = problems + ['', 'Queries executed:']
+            lines.extend('  {}'.format(statement) for statement, _ in self.queries)
+            pytest.fail('\n'.join(lines), pytrace=False)
+
+
+def get_profile(item):
+    '''
+    Return the profile of a test item, creating it if it doesn't exist yet.
+    '''
+    profile = getattr(item, '_sqla_profile', None)
+    if profile is None:
+        profiler = item.config._sqla_profiler
+        profile = item._sqla_profile = DatabaseProfile(item.nodeid,
+                                                       explain_threshold=profiler.explain_threshold)
+
+    return profile
+
+
+class Profiler(object):
+    '''
+    Collect the profiles of every test in a session and report on them. An
+    instance gets registered as a pytest plugin when profiling is enabled.
+    '''
+    def __init__(self, config, json_path=None, explain_threshold=None, limit=10):
+        self.json_path = json_path
+        self.explain_threshold = explain_threshold
+        self.limit = limit
+        self.tests = []
+
+        # pytest-xdist workers send their reports to the controller, which
+        # does the reporting for the whole run
+        self.is_worker = hasattr(config, 'workerinput')
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_fixture_setup(self, fixturedef, request):
+        if fixturedef.argname not in PROFILED_FIXTURES:
+            yield
+            return
+
+        profile = get_profile(request.node)
+        start = time.perf_counter()
+
+        yield
+
+        profile.setup_time += time.perf_counter() - start
+
+        # Finalizers run in reverse order, so this one marks the start of the
+        # fixture's teardown
+        fixturedef.addfinalizer(functools.partial(profile.start_teardown, fixturedef.argname))
+
+    def pytest_fixture_post_finalizer(self, fixturedef, request):
+        profile = getattr(request.node, '_sqla_profile', None)
+        if profile is not None:
+            profile.end_teardown(fixturedef.argname)
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_makereport(self, item, call):
+        outcome = yield
+
+        profile = getattr(item, '_sqla_profile', None)
+        if profile is None:
+            return
+
+        if call.when == 'call' and profile.plans:
+            # Show the plans along with the test's output
+            outcome.get_result().sections.append(
+                ('sqla slow query plans', '\n'.join(format_plan(plan) for plan in profile.plans)))
+
+        if call.when == 'teardown':
+            # Attach the profile to the report, since reports are what
+            # pytest-xdist workers send back to the controller
+            outcome.get_result().sqla_profile = profile.as_dict()
+            item._sqla_profile = None
+
+    def pytest_runtest_logreport(self, report):
+        profile = getattr(report, 'sqla_profile', None)
+        if profile is not None:
+            self.add(profile)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self.is_worker:
+            self.summarize(terminalreporter)
+
+    def pytest_sessionfinish(self, session):
+        if self.json_path and not self.is_worker:
+            self.write_json()
+
+    def add(self, profile):
+        '''
+        Add a test profile, in the form returned by `DatabaseProfile.as_dict()`.
+        '''
+        self.tests.append(profile)
+
+    def slowest_tests(self):
+        def total_time(test):
+            return test['sql_time'] + test['setup_time'] + test['teardown_time']
+
+        return sorted(self.tests, key=total_time, reverse=True)[:self.limit]
+
+    def queries(self):
+        '''
+        Aggregate the queries run by every test, ordered by their total time.
+        '''
+        totals = {}
+        for test in self.tests:
+            for query in test['queries']:
+                count, total = totals.get(query['statement'], (0, 0.0))
+                totals[query['statement']] = (count + query['count'], total + query['time'])
+
+        queries = [{'statement': statement, 'count': count, 'time': total}
+                   for statement, (count, total) in totals.items()]
+
+        return sorted(queries, key=lambda query: query['time'], reverse=True)
+
+    def plans(self):
+        '''
+        Collect the query plans of the slow statements of every test, ordered
+        by how long the statements took.
+        '''
+        plans = [dict(plan, nodeid=test['nodeid'])
+                 for test in self.tests for plan in test.get('plans', ())]
+
+        return sorted(plans, key=lambda plan: plan['time'], reverse=True)
+
+    def write_json(self):
+        with open(self.json_path, 'w') as f:
+            json.dump({'tests': self.tests, 'queries': self.queries()}, f, indent=2)
+
+    def summarize(self, terminalreporter):
+        terminalreporter.write_sep('=', 'pytest-flask-sqlalchemy profile')
+
+        terminalreporter.write_line('Slowest tests:')
+        for test in self.slowest_tests():
+            terminalreporter.write_line(
+                '  {sql_time:.4f}s sql  {setup_time:.4f}s setup  {teardown_time:.4f}s teardown  '
+                '{statements} statements  {rows} rows  {savepoints} savepoints  '
+                '{rehydrated} rehydrated  {nodeid}'.format(**test)
+            )
+
+        terminalreporter.write_line('Heaviest queries:')
+        for query in self.queries()[:self.limit]:
+            statement = ' '.join(query['statement'].split())
+            terminalreporter.write_line(
+                '  {:.4f}s  {}x  {}'.format(query['time'], query['count'], statement[:120])
+            )
+
+        if self.explain_threshold is not None:
+            terminalreporter.write_line('Slowest query plans:')
+            for plan in self.plans()[:self.limit]:
+                terminalreporter.write_line('  {}'.format(plan['nodeid']))
+                terminalreporter.write_line(format_plan(plan, indent='    '))
+
+
+def format_plan(plan, indent=''):
+    '''
+    Format the query plan of a slow statement, as recorded by `DatabaseProfile`.
+    '''
+    statement = ' '.join(plan['statement'].split())
+    lines = ['{:.4f}s  {}'.format(plan['time'], statement[:120])]
+    lines.extend('  ' + line for line in plan['plan'])
+
+    return '\n'.join(indent + line for line in lines)
@@ -0,0 +1,94 @@
+import re
+
+import sqlalchemy as sa
+
+from . import dialects
+from .sessions import create_scoped_session
+
+
+# Statements that only read from the database
+READ_STATEMENT = re.compile(r'^\s*(SELECT|WITH|VALUES|EXPLAIN|SHOW|DESCRIBE|PRAGMA|BEGIN|' +
+                            r'SET\s+TRANSACTION)\b', re.IGNORECASE)
+
+
+class ReadOnlyError(Exception):
+    '''
+    Raised when a statement that may write to the database runs in a read-only
+    snapshot.
+    '''
+
+
+def _refuse_writes(conn, cursor, statement, parameters, context, executemany):
+    if not READ_STATEMENT.match(statement):
+        raise ReadOnlyError('db_session_readonly can only read from the database, but '
+                            'tried to run: {}'.format(' '.join(statement.split())[:200]))
+
+
+class ReadOnlySnapshot(object):
+    '''
+    A read-only transaction shared by consecutive tests that use
+    `db_session_readonly`, along with the session bound to it.
+
+    On Postgres and MySQL the transaction is REPEATABLE READ and READ ONLY, so
+    every test sees the same snapshot of the database. Statements that may write
+    are refused before they reach the database, whatever the dialect.
+    '''
+    def __init__(self, _db):
+        self._db = _db
+        self.connection = None
+        self.transaction = None
+        self.session = None
+
+    def __repr__(self):
+        return '<ReadOnlySnapshot connection={!r}>'.format(self.connection)
+
+    @property
+    def is_open(self):
+        return self.session is not None
+
+    def open(self):
+        '''
+        Begin the transaction and create its session, if that hasn't been done
+        since the snapshot was last released, and return the session.
+        '''
+        if self.session is None:
+            engine = self._db.engine
+            dialects.enable_savepoints(engine)
+
+            connection = engine.connect()
+            sa.event.listen(connection, 'before_cursor_execute', _refuse_writes)
+
+            self.transaction = dialects.begin_read_only(connection)
+            self.connection = connection
+            self.session = create_scoped_session(self._db, dict(bind=connection, binds={}))
+
+        return self.session
+
+    def check(self):
+        '''
+        Release the snapshot if the test that just finished left changes in the
+        session, or tried to write and ended the transaction.
+        '''
+        session = self.session
+        if session is None:
+            return
+
+        if (session.new or session.dirty or session.deleted or not session.is_active or
+                not self.transaction.is_active):
+            self.release()
+
+    def release(self):
+        '''
+        End the transaction and return its connection to the pool. The next
+        test to use the snapshot begins a new one.
+        '''
+        if self.session is None:
+            return
+
+        session, connection, transaction = self.session, self.connection, self.transaction
+        self.session = self.connection = self.transaction = None
+
+        session.remove()
+        if transaction.is_active:
+            transaction.rollback()
+        connection.close()
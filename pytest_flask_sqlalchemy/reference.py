@@ -0,0 +1,48 @@
+from .sessions import create_scoped_session
+
+
+class ReferenceCache(object):
+    '''
+    The rows of reference tables, like countries, currencies or feature flags,
+    that tests look up over and over. They are loaded once and merged into the
+    session of each test without querying the database again, so that `get()`
+    and lazy loads of them are answered from the identity map.
+    '''
+    def __init__(self, _db, models):
+        self._db = _db
+        self.models = list(models)
+        self.objects = None
+
+    def __repr__(self):
+        return '<ReferenceCache models={}>'.format(len(self.models))
+
+    def load(self):
+        '''
+        Load every row of the reference models, if that hasn't been done yet,
+        and return them detached from the session that loaded them.
+        '''
+        if self.objects is None:
+            # Flask-SQLAlchemy's session picks the engine of each model's bind
+            session = create_scoped_session(self._db, {})
+            try:
+                objects = []
+                for model in self.models:
+                    objects.extend(session.query(model).all())
+
+                session.expunge_all()
+            finally:
+                session.remove()
+
+            self.objects = objects
+
+        return self.objects
+
+    def populate(self, session):
+        '''
+        Put a copy of each reference row in the identity map of a session, which
+        the session treats as if it had loaded the row itself.
+        '''
+        # The identity map only holds weak references to unmodified objects,
+        # so the session has to keep the copies alive itself
+        session.info['reference_objects'] = [session.merge(obj, load=False)
+                                             for obj in self.load()]
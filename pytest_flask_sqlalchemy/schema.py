@@ -0,0 +1,159 @@
+import hashlib
+import json
+
+import sqlalchemy as sa
+
+from . import dialects
+
+
+def _describe_constraint(constraint):
+    description = {
+        'type': type(constraint).__name__,
+        'name': constraint.name,
+        'columns': sorted(column.name for column in constraint.columns),
+    }
+
+    if isinstance(constraint, sa.ForeignKeyConstraint):
+        description['references'] = sorted(element.target_fullname
+                                           for element in constraint.elements)
+        description['ondelete'] = constraint.ondelete
+        description['onupdate'] = constraint.onupdate
+    elif isinstance(constraint, sa.CheckConstraint):
+        description['sqltext'] = str(constraint.sqltext)
+
+    return description
+
+
+def _describe_table(table):
+    columns = []
+    for column in table.columns:
+        server_default = getattr(column.server_default, 'arg', None)
+        columns.append({
+            'name': column.name,
+            'type': repr(column.type),
+            'nullable': column.nullable,
+            'primary_key': column.primary_key,
+            'server_default': None if server_default is None else str(server_default),
+        })
+
+    indexes = [{
+        'name': index.name,
+        'columns': [str(expression) for expression in index.expressions],
+        'unique': index.unique,
+    } for index in table.indexes]
+
+    constraints = [_describe_constraint(constraint) for constraint in table.constraints]
+
+    return {
+        'name': table.name,
+        'schema': table.schema,
+        'columns': columns,
+        'indexes': sorted(indexes, key=lambda index: json.dumps(index, sort_keys=True)),
+        'constraints': sorted(constraints, key=lambda constraint: json.dumps(constraint, sort_keys=True)),
+    }
+
+
+def fingerprint(metadata):
+    '''
+    Return a hash of the tables, columns, indexes and constraints in a MetaData
+    object, which changes whenever the schema that it would build changes.
+    '''
+    tables = [_describe_table(table) for _, table in sorted(metadata.tables.items())]
+    serialized = json.dumps(tables, sort_keys=True, default=str)
+
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+
+class SchemaCache(object):
+    '''
+    Keep track of the schema fingerprint that was last built into each database,
+    using the pytest cache so that it carries over between test runs.
+    '''
+    key = 'pytest_flask_sqlalchemy/schemas'
+
+    def __init__(self, cache=None, enabled=True):
+        # The cache is None if the cacheprovider plugin has been disabled
+        self.cache = cache
+        self.enabled = enabled and cache is not None
+        self.fingerprints = {}
+
+    def _url_key(self, url):
+        # The repr of a URL hides its password
+        return repr(url)
+
+    def is_current(self, url, metadata_fingerprint):
+        '''
+        Check whether the schema in the database at `url` was built from metadata
+        with the given fingerprint.
+        '''
+        if not self.enabled:
+            return False
+
+        key = self._url_key(url)
+        if key in self.fingerprints:
+            return self.fingerprints[key] == metadata_fingerprint
+
+        return self.cache.get(self.key, {}).get(key) == metadata_fingerprint
+
+    def record(self, url, metadata_fingerprint, persist=True):
+        '''
+        Record that the schema in the database at `url` was built from metadata
+        with the given fingerprint. Databases that won't outlive the test run
+        don't need to be persisted to the pytest cache.
+        '''
+        if not self.enabled:
+            return
+
+        key = self._url_key(url)
+        self.fingerprints[key] = metadata_fingerprint
+
+        if persist:
+            # Read the cache again in case another pytest-xdist worker has
+            # written to it since this one started
+            fingerprints = self.cache.get(self.key, {})
+            fingerprints[key] = metadata_fingerprint
+            self.cache.set(self.key, fingerprints)
+
+    def create_all(self, db):
+        '''
+        Build the tables for a Flask-SQLAlchemy object, unless the database
+        already holds a schema built from the same metadata. Return True if the
+        schema was built, and False if it was reused.
+        '''
+        metadata_fingerprint = fingerprint(db.metadata)
+
+        if self.is_current(db.engine.url, metadata_fingerprint) and _has_tables(db):
+            return False
+
+        # Drop any stale tables first, since `create_all()` skips tables that
+        # already exist even if their definitions have changed
+        if self.enabled:
+            db.drop_all()
+        db.create_all()
+
+        # In-memory databases don't outlive the test run
+        self.record(db.engine.url, metadata_fingerprint,
+                    persist=not dialects.is_memory_database(db.engine.url))
+
+        return True
+
+
+def _has_tables(db):
+    '''
+    Check that every table for the default bind of a Flask-SQLAlchemy object
+    exists in its database.
+    '''
+    inspector = sa.inspect(db.engine)
+    existing = {}
+
+    for table in db.metadata.tables.values():
+        if table.info.get('bind_key') is not None:
+            continue
+
+        if table.schema not in existing:
+            existing[table.schema] = set(inspector.get_table_names(schema=table.schema))
+
+        if table.name not in existing[table.schema]:
+            return False
+
+    return True
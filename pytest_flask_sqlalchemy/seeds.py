@@ -0,0 +1,149 @@
+import csv
+import itertools
+import json
+import os
+
+try:
+    import yaml
+except ImportError:
+    # Loading YAML seed files needs PyYAML, which is an optional dependency
+    yaml = None
+
+
+def _check_tables(path, data):
+    if not isinstance(data, dict) or not all(isinstance(rows, list) for rows in data.values()):
+        raise ValueError('Seed file {} should map table names to lists of rows'.format(path))
+
+    for table, rows in data.items():
+        if not all(isinstance(row, dict) for row in rows):
+            raise ValueError('Seed file {} has rows for table {!r} that are not mappings '
+                             'of column names to values'.format(path, table))
+
+    return data
+
+
+def _parse_json(path):
+    with open(path) as f:
+        return _check_tables(path, json.load(f))
+
+
+def _parse_yaml(path):
+    if yaml is None:
+        raise ValueError('Loading seed file {} requires PyYAML, which is not '
+                         'installed'.format(path))
+
+    with open(path) as f:
+        return _check_tables(path, yaml.safe_load(f) or {})
+
+
+def _parse_csv(path):
+    # A CSV file holds the rows of the table it's named after, and leaves out
+    # the values of the columns that should be NULL
+    table = os.path.splitext(os.path.basename(path))[0]
+    with open(path, newline='') as f:
+        rows = [{column: value if value != '' else None for column, value in row.items()}
+                for row in csv.DictReader(f)]
+
+    return {table: rows}
+
+
+PARSERS = {
+    '.json': _parse_json,
+    '.yaml': _parse_yaml,
+    '.yml': _parse_yaml,
+    '.csv': _parse_csv,
+}
+
+
+def parse(path):
+    '''
+    Parse a seed file into a dict of the rows it holds for each table, keyed by
+    table name.
+    '''
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        parser = PARSERS[extension]
+    except KeyError:
+        raise ValueError('Unknown format of seed file {} (expected one of: {})'
+                         .format(path, ', '.join(sorted(PARSERS))))
+
+    if not os.path.exists(path):
+        raise ValueError('Seed file {} does not exist'.format(path))
+
+    return parser(path)
+
+
+class SeedCache(object):
+    '''
+    The parsed contents of the seed files that tests load, so that each file
+    gets parsed once per test run however many tests load it.
+    '''
+    def __init__(self):
+        self._files = {}
+
+    def __repr__(self):
+        return '<SeedCache files={}>'.format(len(self._files))
+
+    def load(self, paths):
+        '''
+        Return the rows in all of the seed files at `paths` for each table,
+        keyed by table name, in the order in which the files list them.
+        '''
+        data = {}
+        for path in paths:
+            path = os.path.abspath(path)
+            if path not in self._files:
+                self._files[path] = parse(path)
+
+            for table, rows in self._files[path].items():
+                data.setdefault(table, []).extend(rows)
+
+        return data
+
+
+def sorted_tables(metadatas):
+    '''
+    Return `(bind_key, table)` pairs for the tables in a dict of MetaData objects
+    keyed by bind key, each table after the ones that it depends on.
+    '''
+    for key, metadata in metadatas.items():
+        for table in metadata.sorted_tables:
+            yield table.info.get('bind_key', key), table
+
+
+def insert(metadatas, data, connection_for):
+    '''
+    Insert the rows in `data` into their tables, with one executemany per run of
+    rows that set the same columns, and tables that others depend on first.
+    `connection_for` is called with the bind key of each table to get the
+    connection to insert its rows on. Return the number of rows inserted into
+    each table.
+    '''
+    tables = list(sorted_tables(metadatas))
+
+    names = {table.key for _, table in tables} | {table.name for _, table in tables}
+    unknown = set(data) - names
+    if unknown:
+        raise ValueError('Seed data for unknown tables: {}'.format(', '.join(sorted(unknown))))
+
+    # Tables can be named with or without their schema
+    remaining = dict(data)
+    counts = {}
+
+    for key, table in tables:
+        name = table.key if table.key in remaining else table.name
+        rows = remaining.pop(name, None)
+        if not rows:
+            continue
+
+        connection = connection_for(key)
+
+        # Rows that set different columns need different INSERT statements,
+        # and keeping them in order leaves rows that refer to earlier rows of
+        # the same table working
+        for _, batch in itertools.groupby(rows, key=lambda row: sorted(row)):
+            connection.execute(table.insert(), list(batch))
+
+        counts[name] = len(rows)
+
+    return counts
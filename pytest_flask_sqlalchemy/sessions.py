@@ -0,0 +1,253 @@
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from .engine import SQLALCHEMY_VERSION, version
+
+
+# SQLAlchemy 2.0 sessions can run inside a transaction that was begun outside of
+# them, with no help from the plugin
+JOIN_EXTERNAL_TRANSACTIONS = SQLALCHEMY_VERSION >= version.parse('2.0')
+
+
+def create_scoped_session(_db, options):
+    '''
+    Create a scoped session from the Flask-SQLAlchemy extension, bound to the
+    test's connection.
+    '''
+    if hasattr(_db, 'create_scoped_session'):
+        return _db.create_scoped_session(options=options)
+
+    # Flask-SQLAlchemy 3 made this method private, and its sessions pick one of
+    # the app's engines before looking at their own bind, which would take
+    # queries outside of the test's transaction
+    from flask_sqlalchemy.session import Session
+
+    class TransactionalSession(Session):
+        def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+            if bind is None:
+                bind = self.bind
+            return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    return _db._make_scoped_session(dict(options, class_=TransactionalSession))
+
+
+def _bind_key(mapper, clause):
+    '''
+    Find the bind key of the table that a session is looking up a bind for.
+    '''
+    table = None
+    if mapper is not None:
+        table = sa.inspect(mapper).local_table
+    elif isinstance(clause, sa.Table):
+        table = clause
+    elif isinstance(getattr(clause, 'table', None), sa.Table):
+        table = clause.table
+
+    if table is None:
+        return None
+
+    # Flask-SQLAlchemy 3 keeps the bind key on the metadata of each bind, and
+    # older versions on the table itself
+    return table.info.get('bind_key', table.metadata.info.get('bind_key'))
+
+
+def _bind_lookup(get_bind, binds):
+    '''
+    Wrap the `get_bind` method of a session so that tables with a bind key use
+    the connection of that bind's transaction.
+    '''
+    def lookup(mapper=None, clause=None, **kwargs):
+        if kwargs.get('bind') is None:
+            key = _bind_key(mapper, clause)
+            if key in binds:
+                return binds[key].connection
+
+        return get_bind(mapper, clause, **kwargs)
+
+    return lookup
+
+
+def expire_modified(session, trans):
+    '''
+    Expire the objects that were added or changed during a session transaction
+    that was just committed.
+    '''
+    for state in list(trans._new) + list(trans._dirty):
+        obj = state.obj()
+        if obj is not None and obj in session:
+            session.expire(obj)
+
+
+class SessionFactory(object):
+    '''
+    The scoped session that `_transaction` hands to each test.
+
+    Building a scoped session from Flask-SQLAlchemy creates a new sessionmaker
+    and registry, and the plugin's event listeners have to be registered on
+    them, so the session is only built once for each `_db` and gets rebound to
+    the transaction of every new test instead. The listeners read the state of
+    the test that is currently running from the factory.
+    '''
+    def __init__(self, expire_on_commit='all'):
+        self.expire_on_commit = expire_on_commit
+        self.session = None
+
+        # The `LazyTransaction` and profile of the test that is currently
+        # running, and the `ReferenceCache` to fill its session from
+        self.transaction = None
+        self.profile = None
+        self.reference = None
+
+        self._db = None
+        self._session_factory = None
+
+    def __repr__(self):
+        return '<SessionFactory transaction={!r}>'.format(self.transaction)
+
+    def bind(self, _db, transaction, profile=None, reference=None):
+        '''
+        Rebind the session to the transaction of a new test, and return it.
+        '''
+        if _db is not self._db:
+            self._build(_db)
+
+        self.transaction = transaction
+        self.profile = profile
+        self.reference = reference
+
+        return self.session
+
+    def reset(self):
+        '''
+        Remove the sessions of the test that just finished.
+        '''
+        self.session.remove()
+
+        # Threads and app contexts other than the test's may have created
+        # sessions too, which would otherwise pile up in the registry
+        sessions = getattr(self.session.registry, 'registry', None)
+        if isinstance(sessions, dict):
+            sessions.clear()
+
+        self.transaction = None
+        self.profile = None
+        self.reference = None
+
+    def _build(self, _db):
+        # The empty `binds` dict is necessary when the session is bound to a
+        # connection, or else Flask-SQLAlchemy won't scope the connection properly
+        options = dict(binds={})
+
+        if JOIN_EXTERNAL_TRANSACTIONS:
+            # SQLAlchemy 2.0 sessions can join an external transaction themselves:
+            # each of the session's transactions runs in a SAVEPOINT, and closing
+            # the session only rolls back its own work
+            options['join_transaction_mode'] = 'create_savepoint'
+            if self.expire_on_commit != 'all':
+                options['expire_on_commit'] = False
+
+            session = create_scoped_session(_db, options)
+            sa.event.listen(session, 'after_commit', self._after_commit)
+        else:
+            session = create_scoped_session(_db, options)
+            session.close = lambda: None
+
+            sa.event.listen(session, 'after_transaction_end', self._restart_savepoint)
+            sa.event.listen(session, 'persistent_to_detached', self._rehydrate_object)
+            sa.event.listen(session, 'deleted_to_detached', self._rehydrate_object)
+
+        sa.event.listen(session, 'after_begin', self._register_engine_proxy)
+
+        # The scoped session only creates a Session once it gets used, which is
+        # when the connection needs to be opened
+        self._session_factory = session.registry.createfunc
+        session.registry.createfunc = self._create_session
+
+        self._db = _db
+        self.session = session
+
+    def _create_session(self):
+        transaction = self.transaction
+        connection = transaction.connection
+        session = self._session_factory(bind=connection)
+
+        if not JOIN_EXTERNAL_TRANSACTIONS:
+            # Begin a nested transaction (any new transactions created in the codebase
+            # will be held until this outer transaction is committed or closed)
+            session.begin_nested()
+
+        if transaction.session_bind is not None:
+            session.bind = transaction.session_bind
+
+        if transaction.binds:
+            session.get_bind = _bind_lookup(session.get_bind, transaction.binds)
+
+        if self.reference is not None:
+            self.reference.populate(session)
+
+        return session
+
+    def _after_commit(self, session):
+        if self.expire_on_commit == 'modified':
+            expire_modified(session, session.get_transaction())
+
+        # Each commit releases a SAVEPOINT, and the session begins a new one
+        # the next time it is used
+        if self.profile is not None:
+            self.profile.savepoints += 1
+
+    def _restart_savepoint(self, session, trans):
+        # Each time the SAVEPOINT for the nested transaction ends, reopen it
+        if trans.nested and not trans._parent.nested:
+            # ensure that state is expired the way
+            # session.commit() at the top level normally does
+            if self.expire_on_commit == 'all':
+                session.expire_all()
+            elif self.expire_on_commit == 'modified':
+                expire_modified(session, trans)
+
+            session.begin_nested()
+
+            if self.profile is not None:
+                self.profile.savepoints += 1
+
+    def _rehydrate_object(self, session, obj):
+        # If an object gets moved to the 'detached' state by a call to flush the session,
+        # add it back into the session (this allows us to see changes made to objects
+        # in the context of a test, even when the change was made elsewhere in
+        # the codebase)
+        session.add(obj)
+
+        if self.profile is not None:
+            self.profile.rehydrated += 1
+
+    def _register_engine_proxy(self, session, trans, connection):
+        # The session looks up the transaction for a bind among the connections
+        # it has begun, which are keyed by the connection and its real Engine.
+        # Register the engine stand-in alongside them, or else each query would
+        # start a new SAVEPOINT that never gets released. The connections of the
+        # app's other binds begin here too
+        transaction = self.transaction
+        if transaction is None or transaction.session_bind is None:
+            return
+
+        if connection is transaction.connection:
+            trans._connections[transaction.session_bind] = trans._connections[connection]
+
+
+class FakeSessionMaker(orm.Session):
+    '''
+    A stand-in for the sessionmakers listed in `mocked-sessionmakers`, which
+    returns the session of the test that is currently running when it gets
+    called. (It needs to be a class because `__call__` methods can't be mocked.)
+    '''
+    def __init__(self, session=None):
+        super().__init__()
+        self.session = session
+
+    def __call__(self):
+        return self.session
+
+    @classmethod
+    def configure(cls, *args, **kwargs):
+        pass
@@ -0,0 +1,74 @@
+import collections
+import concurrent.futures
+
+
+def release_connection(connection, transaction):
+    '''
+    Roll back the outer transaction of a test and return its connection to the pool.
+    '''
+    getattr(transaction, 'force_rollback', transaction.rollback)()
+    connection.force_close()
+
+
+class BackgroundTeardown(object):
+    '''
+    Roll back the transactions of finished tests and return their connections
+    to the pool in background threads, so that the next test can start on
+    another connection from the pool straight away.
+
+    At most `max_pending` connections are released in the background at once,
+    so that they can't use up the pool: a test that finishes while that many
+    are still outstanding waits for the oldest one.
+    '''
+    def __init__(self, max_pending):
+        self.max_pending = max_pending
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_pending, thread_name_prefix='pytest-flask-sqlalchemy-teardown')
+        self._pending = collections.deque()
+        self._errors = []
+
+    def __repr__(self):
+        return '<BackgroundTeardown pending={}>'.format(len(self._pending))
+
+    def release(self, connection, transaction):
+        '''
+        Release a connection in the background, where its dialect allows it.
+        '''
+        # sqlite3 connections can't be used from other threads, and in-memory
+        # databases are private to the thread that opened them
+        if connection.dialect.name == 'sqlite':
+            release_connection(connection, transaction)
+            return
+
+        while len(self._pending) >= self.max_pending:
+            self._pending.popleft().result()
+
+        self._pending.append(self._executor.submit(self._release, connection, transaction))
+
+    def _release(self, connection, transaction):
+        try:
+            release_connection(connection, transaction)
+        except Exception as e:
+            self._errors.append(e)
+
+            # Don't let a connection in an unknown state go back to the pool
+            if not connection.closed:
+                connection.invalidate()
+
+    def wait(self):
+        '''
+        Wait for every outstanding release, and raise the first error that any
+        of them ran into.
+        '''
+        while self._pending:
+            self._pending.popleft().result()
+
+        if self._errors:
+            errors, self._errors = self._errors, []
+            raise errors[0]
+
+    def shutdown(self):
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown()
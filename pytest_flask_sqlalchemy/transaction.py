@@ -0,0 +1,86 @@
+import threading
+
+
+class LazyTransaction(object):
+    '''
+    The connection, outer transaction and session that isolate a test.
+
+    Checking out a connection and beginning a transaction on it costs at least
+    one round trip to the database, which is wasted on tests that never run any
+    SQL. So nothing is opened until the test first uses the session, the
+    engine stand-in or the connection, at which point `begin` gets called to
+    open them and return the `(connection, transaction)` pair.
+
+    Unpacking the object as a `(connection, transaction, session)` tuple opens
+    the connection as well.
+    '''
+    def __init__(self, begin, session=None, lock=None):
+        self._begin = begin
+        self._connection = None
+        self._transaction = None
+        self._callbacks = []
+
+        # Threads in the code under test may all try to open the connection
+        # the first time they use it
+        self._open_lock = threading.RLock()
+
+        self.session = session
+
+        # The `ConnectionLock` that serialises the threads sharing the
+        # connection, if they need to be
+        self.lock = lock
+
+        # The transactions of the app's other binds, keyed by their bind key
+        self.binds = {}
+
+        # The bind to give the session once it gets created, if it shouldn't
+        # be the connection
+        self.session_bind = None
+
+    def __repr__(self):
+        return '<LazyTransaction connection={!r}>'.format(self._connection)
+
+    def __iter__(self):
+        return iter((self.connection, self.transaction, self.session))
+
+    @property
+    def is_open(self):
+        return self._connection is not None
+
+    def open(self):
+        '''
+        Open the connection and transaction, if they haven't been opened yet.
+        '''
+        if self._connection is None:
+            with self._open_lock:
+                if self._connection is None:
+                    connection, self._transaction = self._begin()
+
+                    # Other threads skip the lock once the connection is set
+                    self._connection = connection
+
+                    callbacks, self._callbacks = self._callbacks, []
+                    for callback in callbacks:
+                        callback(self._connection)
+
+        return self._connection, self._transaction
+
+    @property
+    def connection(self):
+        return self.open()[0]
+
+    @property
+    def transaction(self):
+        return self.open()[1]
+
+    def on_open(self, callback):
+        '''
+        Call `callback` with the connection once it has been opened, or right
+        away if it is already open.
+        '''
+        with self._open_lock:
+            if self._connection is None:
+                self._callbacks.append(callback)
+                return
+
+        callback(self._connection)
@@ -16,12 +16,16 @@ setup(
     license='MIT',
     version='1.1.0',
     packages=['pytest_flask_sqlalchemy'],
-    install_requires=['pytest>=3.2.1',
-                      'pytest-mock>=1.6.2',
+    python_requires='>=3.7',
+    install_requires=['pytest>=3.9',
                       'SQLAlchemy>=1.2.2',
                       'Flask-SQLAlchemy>=2.3',
                       'packaging>=14.1'],
-    extras_require={'tests': ['pytest-postgresql>=2.4.0,<4.0.0', 'psycopg2-binary', 'pytest>=6.0.1']},
+    extras_require={'tests': ['pytest-postgresql>=2.4.0,<4.0.0', 'psycopg2-binary', 'pytest>=6.0.1',
+                              'pytest-xdist', 'pytest-asyncio', 'aiosqlite'],
+                    'async': ['pytest-asyncio', 'SQLAlchemy[asyncio]>=1.4'],
+                    'yaml': ['PyYAML'],
+                    'benchmarks': ['pytest-benchmark', 'psycopg2-binary']},
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Plugins',
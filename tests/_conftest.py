@@ -41,13 +41,19 @@ def database(request):
 @pytest.fixture(scope='session')
 def app(database):
     '''
-    Create a Flask app context for the tests.
+    Create a Flask app context for the tests. Flask-SQLAlchemy 3 can only find
+    its engines within an app context, so keep one pushed for the whole session.
     '''
     app = Flask(__name__)
 
     app.config['SQLALCHEMY_DATABASE_URI'] = DB_CONN
 
-    return app
+    ctx = app.app_context()
+    ctx.push()
+
+    yield app
+
+    ctx.pop()
 
 
 @pytest.fixture(scope='session')
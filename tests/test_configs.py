@@ -1,3 +1,6 @@
+import json
+
+
 def test_mocked_engines(db_testdir):
     '''
     Test that we can specify paths to specific Engine objects that the plugin
@@ -9,10 +12,12 @@ def test_mocked_engines(db_testdir):
     """)
 
     db_testdir.makepyfile("""
+        from pytest_flask_sqlalchemy.engine import TransactionalEngine
+
         def test_mocked_engines(db_engine):
             from collections import namedtuple, deque
-            assert str(namedtuple).startswith("<MagicMock spec='Engine'")
-            assert str(deque).startswith("<MagicMock spec='Engine'")
+            assert isinstance(namedtuple, TransactionalEngine)
+            assert isinstance(deque, TransactionalEngine)
     """)
 
     result = db_testdir.runpytest()
@@ -53,8 +58,8 @@ def test_mocked_sessionmakers(db_testdir):
     db_testdir.makepyfile("""
         def test_mocked_sessionmakers(db_session):
             from collections import namedtuple, Counter
-            assert str(namedtuple).startswith("<pytest_flask_sqlalchemy.fixtures._session.<locals>.FakeSessionMaker")
-            assert str(Counter).startswith("<pytest_flask_sqlalchemy.fixtures._session.<locals>.FakeSessionMaker")
+            assert str(namedtuple).startswith("<pytest_flask_sqlalchemy.sessions.FakeSessionMaker")
+            assert str(Counter).startswith("<pytest_flask_sqlalchemy.sessions.FakeSessionMaker")
     """)
 
     result = db_testdir.runpytest()
@@ -133,3 +138,222 @@ def test_missing_db_fixture(testdir):
     result.stdout.fnmatch_lines([
         '*NotImplementedError: _db fixture not defined*'
     ])
+
+
+def test_invalid_mocked_path(db_testdir):
+    '''
+    Test that a path in one of the mocked-* options that can't be imported fails
+    the test run up front, instead of failing each test that uses the fixtures.
+    '''
+    db_testdir.makeini("""
+        [pytest]
+        mocked-engines=collections.not_a_real_engine
+    """)
+
+    db_testdir.makepyfile("""
+        def test_invalid_mocked_path(db_engine):
+            assert True
+    """)
+
+    result = db_testdir.runpytest()
+    assert result.ret != 0
+    result.stderr.fnmatch_lines([
+        '*Invalid mocked-engines option: collections.not_a_real_engine could not be imported: *'
+    ])
+
+
+def test_mocked_path_import_error(db_testdir):
+    '''
+    Test that a mocked-* path whose module fails to import reports the error that
+    it failed with.
+    '''
+    db_testdir.makeini("""
+        [pytest]
+        mocked-engines=broken_app.engine
+    """)
+
+    db_testdir.makepyfile(broken_app="""
+        import not_a_real_dependency
+
+        engine = None
+    """)
+    db_testdir.syspathinsert()
+
+    db_testdir.makepyfile("""
+        def test_mocked_path_import_error(db_engine):
+            assert True
+    """)
+
+    result = db_testdir.runpytest()
+    assert result.ret != 0
+    result.stderr.fnmatch_lines([
+        "*broken_app.engine could not be imported: *No module named 'not_a_real_dependency'*"
+    ])
+
+
+def test_sqla_profile(db_testdir):
+    '''
+    Test that the --sqla-profile option reports on the database work done in each
+    test, and that --sqla-profile-json exports it.
+    '''
+    db_testdir.makepyfile("""
+        def test_sqla_profile(person, db_session):
+            db_session.add(person(id=1, name='tester'))
+            db_session.commit()
+
+            assert db_session.query(person).get(1).name == 'tester'
+    """)
+
+    result = db_testdir.runpytest('--sqla-profile', '--sqla-profile-json=profile.json')
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines([
+        '*pytest-flask-sqlalchemy profile*',
+        'Slowest tests:',
+        '*test_sqla_profile.py::test_sqla_profile',
+        'Heaviest queries:',
+        '*INSERT INTO person*',
+    ])
+
+    with open(str(db_testdir.tmpdir.join('profile.json'))) as f:
+        profile = json.load(f)
+
+    test, = profile['tests']
+    assert test['nodeid'] == 'test_sqla_profile.py::test_sqla_profile'
+    assert test['statements'] > 0
+    assert test['savepoints'] > 0
+    assert any('INSERT INTO person' in query['statement'] for query in profile['queries'])
+
+
+def test_sqla_explain(db_testdir):
+    '''
+    Test that the --sqla-explain option records the query plans of slow
+    statements without disturbing the test's transaction.
+    '''
+    db_testdir.makepyfile("""
+        def test_sqla_explain(person, db_session):
+            db_session.add(person(id=1, name='tester'))
+            db_session.commit()
+
+            assert db_session.query(person).filter_by(name='tester').one().id == 1
+    """)
+
+    # A threshold of 0 explains every statement
+    result = db_testdir.runpytest('--sqla-explain=0', '--sqla-profile-json=profile.json', '-rP')
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines([
+        '*sqla slow query plans*',
+        '*SELECT*FROM person*',
+        '*pytest-flask-sqlalchemy profile*',
+        'Slowest query plans:',
+        '  test_sqla_explain.py::test_sqla_explain',
+    ])
+
+    with open(str(db_testdir.tmpdir.join('profile.json'))) as f:
+        profile = json.load(f)
+
+    test, = profile['tests']
+    select, = [plan for plan in test['plans'] if plan['statement'].lstrip().startswith('SELECT')]
+    assert select['plan']
+
+
+def test_diagnostic_thresholds(db_testdir):
+    '''
+    Test that the warn-* options warn about tests that open too many savepoints
+    or leave event listeners behind.
+    '''
+    db_testdir.makeini("""
+        [pytest]
+        warn-savepoint-depth=2
+        warn-savepoints=2
+        warn-leaked-listeners=0
+        warn-registry-objects=0
+    """)
+
+    db_testdir.makepyfile("""
+        import sqlalchemy as sa
+
+        def test_diagnostics(person, db_session):
+            # Rolling back to a savepoint keeps it open, so each rollback
+            # leaves the savepoint stack one level deeper
+            for id in range(3):
+                db_session.add(person(id=id, name='tester'))
+                db_session.flush()
+                db_session.rollback()
+
+            sa.event.listen(db_session, 'after_commit', lambda session: None)
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=1)
+    result.stdout.fnmatch_lines([
+        '*DiagnosticWarning: *test_diagnostics: * nested savepoints were open at once '
+        '(warn-savepoint-depth is 2)',
+        '*DiagnosticWarning: *test_diagnostics: * savepoints were opened (warn-savepoints is 2)',
+        '*DiagnosticWarning: *test_diagnostics: 1 event listeners were still attached after '
+        'teardown (warn-leaked-listeners is 0)',
+    ])
+    assert 'warn-registry-objects' not in result.stdout.str()
+
+
+def test_diagnostics_without_listener_registry(db_testdir):
+    '''
+    Test that the leaked-listener check is skipped when SQLAlchemy's listener
+    registry can't be found, instead of breaking the test.
+    '''
+    db_testdir.makeini("""
+        [pytest]
+        warn-leaked-listeners=0
+    """)
+
+    db_testdir.makepyfile("""
+        import pytest
+        import sqlalchemy as sa
+
+        from pytest_flask_sqlalchemy import diagnostics
+
+        @pytest.fixture(autouse=True)
+        def hide_registry(monkeypatch):
+            monkeypatch.setattr(diagnostics, 'event_registry', object())
+
+        def test_leak_listener(db_session):
+            sa.event.listen(db_session, 'after_commit', lambda session: None)
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=1)
+    assert 'DiagnosticWarning' not in result.stdout.str()
+
+
+def test_expire_on_commit(db_testdir):
+    '''
+    Test that the expire-on-commit option can limit the objects expired by a
+    commit to the ones that it modified.
+    '''
+    db_testdir.makeini("""
+        [pytest]
+        expire-on-commit=modified
+    """)
+
+    db_testdir.makepyfile("""
+        import sqlalchemy as sa
+
+        def test_expire_on_commit(person, db_session):
+            untouched = person(id=1, name='untouched')
+            modified = person(id=2, name='modified')
+            db_session.add_all([untouched, modified])
+            db_session.commit()
+
+            # Load the state of both objects again
+            assert untouched.name == 'untouched'
+            assert modified.name == 'modified'
+
+            modified.name = 'changed'
+            db_session.commit()
+
+            assert 'name' not in sa.inspect(modified).dict
+            assert 'name' in sa.inspect(untouched).dict
+            assert modified.name == 'changed'
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=1)
@@ -1,5 +1,10 @@
 import os
 
+import pytest
+import sqlalchemy as sa
+
+from pytest_flask_sqlalchemy import databases
+
 
 def test_use_db_session_to_alter_database(db_testdir):
     '''
@@ -8,6 +13,8 @@ def test_use_db_session_to_alter_database(db_testdir):
     '''
     # Load tests from file
     db_testdir.makepyfile("""
+        import sqlalchemy as sa
+
         def test_use_db_session_to_alter_database(person, db_engine, db_session):
 
             # Create a new object instance using the ORM
@@ -22,13 +29,13 @@ def test_use_db_session_to_alter_database(db_testdir):
             db_session.commit()
 
             # Create a new object instance by emitting raw SQL from the session object
-            db_session.execute('''
+            db_session.execute(sa.text('''
                 insert into person (id, name)
                 values (2, 'second tester')
-            ''')
+            '''))
 
             # Make sure that the session object has registered changes
-            name_list = db_session.execute('''select name from person''').fetchall()
+            name_list = db_session.execute(sa.text('''select name from person''')).fetchall()
             names = [name[0] for name in name_list]
 
             assert 'tester' in names
@@ -36,7 +43,7 @@ def test_use_db_session_to_alter_database(db_testdir):
 
         def test_db_session_changes_dont_persist(person, db_engine, db_session):
 
-            assert not db_engine.execute('''select * from person''').fetchone()
+            assert not db_engine.execute(sa.text('''select * from person''')).fetchone()
             assert not db_session.query(person).first()
     """)
 
@@ -50,19 +57,21 @@ def test_use_db_engine_to_alter_database(db_testdir):
     Use the `db_engine` fixture to alter the database directly.
     '''
     db_testdir.makepyfile("""
+        import sqlalchemy as sa
+
         def test_use_db_engine_to_alter_database(person, db_engine, db_session):
 
-            db_engine.execute('''
+            db_engine.execute(sa.text('''
                 insert into person (id, name)
                 values (1, 'tester')
-            ''')
+            '''))
 
             # Use the contextmanager to retrieve a connection
             with db_engine.begin() as conn:
-                conn.execute('''
+                conn.execute(sa.text('''
                     insert into person (id, name)
                     values (2, 'second tester')
-                ''')
+                '''))
 
             first_person = db_session.query(person).get(1)
             second_person = db_session.query(person).get(2)
@@ -72,7 +81,7 @@ def test_use_db_engine_to_alter_database(db_testdir):
 
         def test_db_engine_changes_dont_persist(person, db_engine, db_session):
 
-            assert not db_engine.execute('''select * from person''').fetchone()
+            assert not db_engine.execute(sa.text('''select * from person''')).fetchone()
             assert not db_session.query(person).first()
     """)
 
@@ -95,38 +104,38 @@ def test_raise_programmingerror_rolls_back_transaction(db_testdir):
             with pytest.raises(sa.exc.ProgrammingError):
                 # Run a query that doesn't correspond to an existing table
                 with db_engine.begin() as conn:
-                    db_engine.execute('''
+                    db_engine.execute(sa.text('''
                         SELECT record_count FROM 'browser'
-                    ''')
+                    '''))
 
             # Handle the ProgrammingError the way we do in the code (try/except block)
             try:
                 with db_engine.begin() as conn:
-                    conn.execute('''
+                    conn.execute(sa.text('''
                         SELECT record_count FROM 'browser'
-                    ''')
+                    '''))
             except sa.exc.ProgrammingError:
                 pass
 
             # This query will raise an InternalError if ProgrammingErrors don't get handled properly,
             # since the ProgrammingError aborts the transaction by default
             with db_engine.begin() as conn:
-                nonexistent_person = conn.execute('''SELECT name FROM person''').fetchone()
+                nonexistent_person = conn.execute(sa.text('''SELECT name FROM person''')).fetchone()
 
             assert not nonexistent_person
 
             # Make some changes that we can check in the following test
-            db_engine.execute('''
+            db_engine.execute(sa.text('''
                 insert into person (id, name)
                 values (1, 'tester')
-            ''')
+            '''))
 
             person = db_session.query(person).get(1)
             assert person.name == 'tester'
 
         def test_raise_programmingerror_changes_dont_persist(person, db_engine, db_session):
 
-            assert not db_engine.execute('''select * from person''').fetchone()
+            assert not db_engine.execute(sa.text('''select * from person''')).fetchone()
             assert not db_session.query(person).first()
     """)
 
@@ -140,15 +149,17 @@ def test_transaction_commit(db_testdir):
     they appear.
     '''
     db_testdir.makepyfile("""
+        import sqlalchemy as sa
+
         def test_transaction_commit(person, db_engine, db_session):
 
             with db_engine.begin() as conn:
                 trans = conn.begin()
 
-                conn.execute('''
+                conn.execute(sa.text('''
                     insert into person (id, name)
                     values (1, 'tester')
-                ''')
+                '''))
 
                 trans.commit()
 
@@ -159,7 +170,42 @@ def test_transaction_commit(db_testdir):
 
         def test_transaction_commit_changes_dont_persist(person, db_engine, db_session):
 
-            assert not db_engine.execute('''select * from person''').fetchone()
+            assert not db_engine.execute(sa.text('''select * from person''')).fetchone()
+            assert not db_session.query(person).first()
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=2)
+
+
+def test_join_transaction_mode(db_testdir):
+    '''
+    Make sure that on SQLAlchemy 2.0, where the session joins the test's
+    transaction itself, committing the session only releases a SAVEPOINT and
+    leaves the test's transaction open to roll back.
+    '''
+    pytest.importorskip('sqlalchemy', minversion='2.0')
+
+    db_testdir.makepyfile("""
+        import sqlalchemy as sa
+
+        def test_session_commit(person, db_engine, db_session):
+            assert db_session().join_transaction_mode == 'create_savepoint'
+
+            db_session.add(person(id=1, name='tester'))
+            db_session.commit()
+
+            connection = db_session.connection()
+            assert connection.in_transaction()
+            assert connection.in_nested_transaction()
+
+            db_session.add(person(id=2, name='second tester'))
+            db_session.commit()
+
+            assert db_engine.execute(sa.text('select count(*) from person')).scalar() == 2
+
+        def test_session_commit_changes_dont_persist(person, db_engine, db_session):
+            assert not db_engine.execute(sa.text('select * from person')).fetchone()
             assert not db_session.query(person).first()
     """)
 
@@ -178,18 +224,18 @@ def test_transaction_rollback(db_testdir):
 
         def test_transaction_rollback(person, db_engine, db_session):
 
-            db_engine.execute('''
+            db_engine.execute(sa.text('''
                 insert into person (id, name)
                 values (1, 'tester')
-            ''')
+            '''))
 
             with db_engine.begin() as conn:
                 trans = conn.begin()
 
                 try:
-                    conn.execute('''
+                    conn.execute(sa.text('''
                         SELECT record_count FROM 'browser'
-                    ''')
+                    '''))
                 except sa.exc.ProgrammingError:
                     trans.rollback()
 
@@ -200,7 +246,7 @@ def test_transaction_rollback(db_testdir):
 
         def test_transaction_rollback_changes_dont_persist(person, db_engine, db_session):
 
-            assert not db_engine.execute('''select * from person''').fetchone()
+            assert not db_engine.execute(sa.text('''select * from person''')).fetchone()
             assert not db_session.query(person).first()
     """)
 
@@ -208,37 +254,68 @@ def test_transaction_rollback(db_testdir):
     result.assert_outcomes(passed=2)
 
 
+def test_engine_only_transaction_rollback(db_testdir):
+    '''
+    Make sure that a test which only uses the engine, and never the session,
+    still runs its transactions nested in the test's own, so that rolling one
+    back leaves the connection usable.
+    '''
+    db_testdir.makepyfile("""
+        import sqlalchemy as sa
+
+        def test_engine_only_transaction_rollback(person, db_engine):
+            conn = db_engine.connect()
+
+            trans = conn.begin()
+            conn.execute(sa.text("insert into person (id, name) values (1, 'rolled back')"))
+            trans.rollback()
+
+            conn.execute(sa.text("insert into person (id, name) values (2, 'tester')"))
+
+            names = [row[0] for row in conn.execute(sa.text('select name from person'))]
+            assert names == ['tester']
+
+        def test_engine_only_changes_dont_persist(person, db_engine):
+            assert not db_engine.execute(sa.text('select * from person')).fetchone()
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=2)
+
+
 def test_drop_table(db_testdir):
     '''
     Make sure that we can drop tables and verify they do not exist in the context
     of a test.
     '''
     db_testdir.makepyfile("""
+        import sqlalchemy as sa
+
         def test_drop_table(person, db_engine):
 
             # Drop the raw table
-            db_engine.execute('''
+            db_engine.execute(sa.text('''
                 DROP TABLE "person"
-            ''')
+            '''))
 
             # Check if the raw table exists
-            existing_tables = db_engine.execute('''
+            existing_tables = db_engine.execute(sa.text('''
                 SELECT relname
                 FROM pg_catalog.pg_class
                 WHERE relkind in ('r', 'm')
                 AND relname = 'person'
-            ''').first()
+            ''')).first()
 
             assert not existing_tables
 
         def test_drop_table_changes_dont_persist(person, db_engine):
 
-            existing_tables = db_engine.execute('''
+            existing_tables = db_engine.execute(sa.text('''
                 SELECT relname
                 FROM pg_catalog.pg_class
                 WHERE relkind in ('r', 'm')
                 AND relname = 'person'
-            ''').first()
+            ''')).first()
 
             assert existing_tables
     """)
@@ -252,14 +329,16 @@ def test_use_raw_connection_to_alter_database(db_testdir):
     Retrieve a raw DBAPI connection and use it to make changes to the database.
     '''
     db_testdir.makepyfile("""
+        import sqlalchemy as sa
+
         def test_use_raw_connection_to_alter_database(person, db_engine, db_session):
 
             # Make some changes so that we can make sure they persist after a raw connection
             # rollback
-            db_engine.execute('''
+            db_engine.execute(sa.text('''
                 insert into person (id, name)
                 values (1, 'tester')
-            ''')
+            '''))
 
             # Make changes with a raw connection
             conn = db_engine.raw_connection()
@@ -273,7 +352,7 @@ def test_use_raw_connection_to_alter_database(db_testdir):
             conn.commit()
 
             # Check to make sure that the changes are visible to the original connection
-            second_person = db_engine.execute('''select name from person where id = 2''').fetchone()[0]
+            second_person = db_engine.execute(sa.text('''select name from person where id = 2''')).fetchone()[0]
 
             assert second_person == 'second tester'
 
@@ -288,7 +367,7 @@ def test_use_raw_connection_to_alter_database(db_testdir):
 
         def test_raw_connection_changes_dont_persist(person, db_engine, db_session):
 
-            assert not db_engine.execute('''select * from person''').fetchone()
+            assert not db_engine.execute(sa.text('''select * from person''')).fetchone()
             assert not db_session.query(person).first()
     """)
 
@@ -296,6 +375,183 @@ def test_use_raw_connection_to_alter_database(db_testdir):
     result.assert_outcomes(passed=2)
 
 
+def test_raw_connection_savepoints(db_testdir):
+    '''
+    Make sure that each raw connection works inside a savepoint of its own, and
+    that the savepoints of several raw connections nest.
+    '''
+    db_testdir.makepyfile("""
+        import sqlalchemy as sa
+
+        def count(db_engine):
+            return db_engine.execute(sa.text('select count(*) from person')).scalar()
+
+        def test_raw_connection_savepoints(person, db_engine):
+            marker = '?' if db_engine.dialect.paramstyle == 'qmark' else '%s'
+            insert = 'insert into person (id, name) values ({0}, {0})'.format(marker)
+
+            outer = db_engine.raw_connection()
+            cursor = outer.cursor()
+            assert cursor.connection is outer
+
+            # Bulk methods go straight to the DBAPI cursor
+            cursor.executemany(insert, [(1, 'first'), (2, 'second')])
+            outer.commit()
+
+            inner = db_engine.raw_connection()
+            assert inner.savepoint != outer.savepoint
+
+            inner_cursor = inner.cursor()
+            inner_cursor.execute(insert, (3, 'third'))
+            inner.rollback()
+            assert count(db_engine) == 2
+
+            # Rolling back the outer connection also rolls back the inner one
+            inner_cursor.execute(insert, (4, 'fourth'))
+            outer.rollback()
+            assert count(db_engine) == 2
+            assert inner.savepoint is None
+
+            inner.close()
+            outer.close()
+            assert count(db_engine) == 2
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=1)
+
+
+def test_db_session_readonly(db_testdir):
+    '''
+    Make sure that consecutive tests using db_session_readonly share one
+    read-only transaction, and that writing to the database fails.
+    '''
+    db_testdir.makepyfile("""
+        import pytest
+        from pytest_flask_sqlalchemy.readonly import ReadOnlyError
+
+        connections = []
+
+        @pytest.fixture(scope='module')
+        def tester(person, _db):
+            # Commit the data, since the snapshot can't see any other test's
+            # transaction
+            _db.session.add(person(id=1, name='tester'))
+            _db.session.commit()
+
+            yield
+
+            _db.session.query(person).delete()
+            _db.session.commit()
+            _db.session.remove()
+
+        def test_read(person, tester, db_session_readonly, _readonly_snapshot):
+            assert db_session_readonly.query(person).one().name == 'tester'
+            connections.append(_readonly_snapshot.connection)
+
+        def test_snapshot_is_shared(person, tester, db_session_readonly, _readonly_snapshot):
+            assert db_session_readonly.query(person).count() == 1
+            assert _readonly_snapshot.connection is connections[0]
+
+        def test_write_fails(person, tester, db_session_readonly):
+            db_session_readonly.add(person(id=2, name='writer'))
+            with pytest.raises(ReadOnlyError):
+                db_session_readonly.flush()
+
+        def test_snapshot_is_replaced(person, tester, db_session_readonly, _readonly_snapshot):
+            assert db_session_readonly.query(person).count() == 1
+            assert _readonly_snapshot.connection is not connections[0]
+
+        def test_transactional_fixtures(person, tester, db_session):
+            assert db_session.query(person).count() == 1
+
+        def test_mixed_fixtures(db_session, db_session_readonly):
+            pass
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=5, errors=1)
+    result.stdout.fnmatch_lines([
+        "*db_session_readonly can't be used along with the transactional fixtures",
+    ])
+
+
+def test_db_seed(db_testdir):
+    '''
+    Make sure that seed files get loaded into the test's transaction, whether a
+    test loads them with the `db_seed` fixture or lists them in a `seed` marker.
+    '''
+    db_testdir.makefile('.json', people='''
+        {"person": [{"id": 1, "name": "tester"}, {"id": 2}]}
+    ''', unknown='''
+        {"nobody": [{"id": 1}]}
+    ''')
+    db_testdir.makefile('.csv', person='id,name\n3,csv tester\n4,\n')
+
+    db_testdir.makepyfile("""
+        import pytest
+
+        def test_db_seed(person, db_seed, db_session):
+            assert db_seed('people.json', 'person.csv') == {'person': 4}
+
+            assert db_session.query(person).get(1).name == 'tester'
+            assert db_session.query(person).get(3).name == 'csv tester'
+            assert db_session.query(person).get(4).name is None
+
+        @pytest.mark.seed('people.json')
+        def test_seed_marker(person, db_session):
+            assert db_session.query(person).get(1).name == 'tester'
+            assert db_session.query(person).get(2).name is None
+
+        def test_seed_changes_dont_persist(person, db_session):
+            assert not db_session.query(person).first()
+
+        def test_seed_unknown_table(db_seed):
+            db_seed('unknown.json')
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=3, failed=1)
+    result.stdout.fnmatch_lines(['*Seed data for unknown tables: nobody*'])
+
+
+def test_reference_models(db_testdir):
+    '''
+    Make sure that the rows of the models returned by `db_reference_models` are
+    in the identity map of each test's session, and that changes to them still
+    don't persist between tests.
+    '''
+    db_testdir.makepyfile("""
+        import pytest
+
+        @pytest.fixture(scope='module')
+        def db_reference_models(person, _db):
+            with _db.engine.begin() as connection:
+                connection.execute(person.__table__.insert(), [{'id': 1, 'name': 'reference'}])
+
+            yield [person]
+
+            with _db.engine.begin() as connection:
+                connection.execute(person.__table__.delete())
+
+        def test_reference_rows_are_cached(person, db_session, db_query_counter):
+            assert db_session.query(person).get(1).name == 'reference'
+            assert db_query_counter.count == 0
+
+        def test_reference_rows_can_change(person, db_session):
+            db_session.query(person).get(1).name = 'changed'
+            db_session.commit()
+
+            assert db_session.query(person).get(1).name == 'changed'
+
+        def test_reference_changes_dont_persist(person, db_session):
+            assert db_session.query(person).get(1).name == 'reference'
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=3)
+
+
 def test_commit_works_with_deleted_dependent(db_testdir):
     '''
     Make sure a commit still works with a dangling reference to a
@@ -336,3 +592,897 @@ def test_commit_works_with_deleted_dependent(db_testdir):
 
     result = db_testdir.runpytest()
     result.assert_outcomes(passed=1)
+
+
+def test_queries_reuse_savepoint(db_testdir):
+    '''
+    Make sure that queries made through the session don't each open a new
+    SAVEPOINT, which would pile up until the end of the test.
+    '''
+    db_testdir.makepyfile("""
+        import sqlalchemy as sa
+
+        def test_queries_reuse_savepoint(person, db_session):
+            savepoints = []
+
+            @sa.event.listens_for(db_session.connection(), 'before_cursor_execute')
+            def count_savepoints(conn, cursor, statement, *args):
+                if statement.startswith('SAVEPOINT'):
+                    savepoints.append(statement)
+
+            people = [person(id=id, name='tester') for id in range(10)]
+            db_session.add_all(people)
+            db_session.commit()
+
+            # Reload each expired instance with a separate query
+            assert all(instance.name == 'tester' for instance in people)
+
+            # The only new SAVEPOINT replaces the one released by the commit
+            assert len(savepoints) == 1
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=1)
+
+
+def test_reuse_connection(db_testdir):
+    '''
+    Make sure that when the `reuse-connection` option is enabled, every test runs
+    on the same connection and changes still roll back between tests.
+    '''
+    db_testdir.makeini("""
+        [pytest]
+        reuse-connection=true
+    """)
+
+    db_testdir.makepyfile("""
+        import sqlalchemy as sa
+
+        connections = []
+
+        def test_reuse_connection_alters_database(person, db_session, _transaction):
+            connection, _, _ = _transaction
+            connections.append(connection)
+
+            db_session.add(person(id=1, name='tester'))
+            db_session.commit()
+
+            assert db_session.query(person).get(1).name == 'tester'
+
+        def test_reuse_connection_changes_dont_persist(person, db_engine, db_session, _transaction):
+            connection, _, _ = _transaction
+            assert connection is connections[0]
+
+            assert not db_engine.execute(sa.text('''select * from person''')).fetchone()
+            assert not db_session.query(person).first()
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=2)
+
+
+def test_background_teardown(db_testdir):
+    '''
+    Make sure that when the `background-teardown` option is set, changes still
+    roll back between tests, and strategies that rebuild the database wait for
+    the rollbacks that are still running.
+    '''
+    db_testdir.makeini("""
+        [pytest]
+        background-teardown=2
+    """)
+
+    db_testdir.makepyfile("""
+        import pytest
+
+        def test_background_teardown_alters_database(person, db_session):
+            db_session.add(person(id=1, name='tester'))
+            db_session.commit()
+
+            assert db_session.query(person).get(1).name == 'tester'
+
+        def test_background_teardown_changes_dont_persist(person, db_session):
+            assert not db_session.query(person).first()
+
+        @pytest.mark.isolation('truncate')
+        def test_background_teardown_waits_for_rollbacks(_background_teardown, db_session):
+            assert _background_teardown is not None
+            assert not _background_teardown._pending
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=3)
+
+
+def test_engine_proxy_is_rebound(db_testdir):
+    '''
+    Make sure that the same Engine stand-in is reused across tests and rebound
+    to each test's connection.
+    '''
+    db_testdir.makepyfile("""
+        engines = []
+
+        def test_engine_proxy_first(db_engine, _transaction):
+            connection, _, _ = _transaction
+            engines.append(db_engine)
+
+            assert db_engine.connect() is connection
+
+        def test_engine_proxy_second(db_engine, _transaction):
+            connection, _, _ = _transaction
+
+            assert db_engine is engines[0]
+            assert db_engine.connect() is connection
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=2)
+
+
+def test_engine_proxy_falls_back_to_engine(db_testdir):
+    '''
+    Make sure that the attributes of the Engine stand-in that aren't redirected
+    to the test's connection come from the real Engine.
+    '''
+    db_testdir.makepyfile("""
+        import pytest
+
+        def test_engine_attributes(_db, db_engine):
+            assert db_engine.pool is _db.engine.pool
+            assert db_engine.echo == _db.engine.echo
+            assert db_engine.dispose == _db.engine.dispose
+
+        def test_missing_attribute(db_engine):
+            with pytest.raises(AttributeError):
+                db_engine.nonexistent
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=2)
+
+
+def test_session_is_rebound(db_testdir):
+    '''
+    Make sure that the same scoped session is reused across tests and rebound
+    to each test's connection.
+    '''
+    db_testdir.makepyfile("""
+        sessions = []
+
+        def test_session_first(person, db_session, _transaction):
+            sessions.append(db_session)
+            db_session.add(person(id=1, name='tester'))
+            db_session.commit()
+
+            assert db_session.connection() is _transaction.connection
+
+        def test_session_second(person, db_session, _transaction):
+            assert db_session is sessions[0]
+            assert not db_session.query(person).first()
+            assert db_session.connection() is _transaction.connection
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=2)
+
+
+def test_lazy_transaction(db_testdir):
+    '''
+    Make sure that tests only check out a connection once they use the database.
+    '''
+    db_testdir.makepyfile("""
+        import sqlalchemy as sa
+
+        def test_database_not_used(db_session, db_engine, _transaction):
+            assert not _transaction.is_open
+
+        def test_session_used(person, db_session, _transaction):
+            assert not db_session.query(person).first()
+            assert _transaction.is_open
+
+        def test_engine_used(db_engine, _transaction):
+            assert db_engine.execute(sa.text('select 1')).scalar() == 1
+            assert _transaction.is_open
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=3)
+
+
+def test_thread_safe_connection(db_testdir):
+    '''
+    Make sure that threads sharing the transactional connection take turns, and
+    that their changes still roll back.
+    '''
+    db_testdir.makeini("""
+        [pytest]
+        thread-safe-connection=true
+    """)
+
+    db_testdir.makepyfile("""
+        import threading
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+
+        import sqlalchemy as sa
+
+        def test_threads_share_connection(person, db_engine, db_connection_lock):
+            def insert_person(id):
+                db_engine.execute(person.__table__.insert(), {'id': id, 'name': 'thread'})
+
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                list(executor.map(insert_person, range(1, 9)))
+
+            assert db_engine.execute(sa.text('select count(*) from person')).scalar() == 8
+            assert db_connection_lock.threads > 1
+
+            # Make a thread wait for the connection while this one holds it
+            with db_connection_lock:
+                thread = threading.Thread(target=insert_person, args=(9,))
+                thread.start()
+                time.sleep(0.1)
+
+            thread.join()
+            assert db_connection_lock.contentions >= 1
+            assert db_connection_lock.max_wait > 0
+
+        def test_changes_rolled_back(person, db_engine):
+            assert db_engine.execute(sa.text('select count(*) from person')).scalar() == 0
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=2)
+
+
+def test_thread_safe_connection_sqlite(testdir):
+    '''
+    Make sure that threads sharing the transactional connection take turns on
+    the engine and on the cursors of a raw connection, against a database that
+    isn't Postgres.
+    '''
+    testdir.makeini("""
+        [pytest]
+        thread-safe-connection=true
+    """)
+
+    testdir.makeconftest("""
+        import pytest
+        from flask import Flask
+        from flask_sqlalchemy import SQLAlchemy
+
+        @pytest.fixture(scope='session')
+        def _db(tmp_path_factory):
+            app = Flask(__name__)
+            app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///{}'.format(
+                tmp_path_factory.mktemp('db') / 'test.db')
+            app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+                'connect_args': {'check_same_thread': False},
+            }
+            app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+            # Flask-SQLAlchemy 3 only finds its engines within an app context
+            with app.app_context():
+                yield SQLAlchemy(app=app)
+
+        @pytest.fixture(scope='session')
+        def person(_db):
+            class Person(_db.Model):
+                __tablename__ = 'person'
+                id = _db.Column(_db.Integer, primary_key=True)
+                name = _db.Column(_db.String(80))
+
+            _db.create_all()
+
+            return Person
+    """)
+
+    testdir.makepyfile("""
+        import threading
+        import time
+
+        import sqlalchemy as sa
+
+        def wait_for_lock(lock, target):
+            # Start a thread while this one holds the lock, and make sure that
+            # the thread waits for it
+            with lock:
+                thread = threading.Thread(target=target)
+                thread.start()
+                time.sleep(0.1)
+                assert thread.is_alive()
+
+            thread.join()
+
+        def test_engine_statements(person, db_engine, db_connection_lock):
+            wait_for_lock(db_connection_lock, lambda: db_engine.execute(
+                person.__table__.insert(), {'id': 1, 'name': 'thread'}))
+
+            assert db_engine.execute(sa.text('select count(*) from person')).scalar() == 1
+            assert db_connection_lock.contentions == 1
+
+        def test_raw_cursor_statements(person, db_engine, db_connection_lock):
+            raw = db_engine.raw_connection()
+
+            def insert_person():
+                cursor = raw.cursor()
+                cursor.execute("insert into person (id, name) values (2, 'raw thread')")
+                cursor.close()
+
+            wait_for_lock(db_connection_lock, insert_person)
+
+            assert db_engine.execute(sa.text('select count(*) from person')).scalar() == 1
+            assert db_connection_lock.contentions == 1
+
+        def test_changes_rolled_back(person, db_engine):
+            assert db_engine.execute(sa.text('select count(*) from person')).scalar() == 0
+    """)
+
+    result = testdir.runpytest()
+    result.assert_outcomes(passed=3)
+
+
+def test_module_and_class_layers(db_testdir):
+    '''
+    Make sure that data loaded by module- and class-scoped fixtures is visible
+    to every test in their scope, while each test's own changes still roll back.
+    '''
+    db_testdir.makepyfile(test_a_layers="""
+        import pytest
+        import sqlalchemy as sa
+
+        @pytest.fixture(scope='session')
+        def module_log(_db):
+            # The person table gets dropped along with the module, so give the
+            # next module a table of its own to check that the layer rolled back
+            metadata = sa.MetaData()
+            table = sa.Table('module_log', metadata, sa.Column('id', sa.Integer, primary_key=True))
+            metadata.create_all(_db.engine)
+
+            yield table
+
+            metadata.drop_all(_db.engine)
+
+        @pytest.fixture(scope='module')
+        def module_person(person, module_log, db_session_module):
+            db_session_module.add(person(id=1, name='module'))
+            db_session_module.execute(module_log.insert().values(id=1))
+            db_session_module.commit()
+
+        @pytest.fixture(scope='class')
+        def class_person(person, module_person, db_session_class):
+            db_session_class.add(person(id=2, name='class'))
+            db_session_class.commit()
+
+        def test_module_data(person, module_person, db_session):
+            assert db_session.query(person).get(1).name == 'module'
+
+            db_session.add(person(id=3, name='test'))
+            db_session.commit()
+
+        def test_test_data_rolled_back(person, module_person, db_session):
+            assert db_session.query(person).count() == 1
+
+        class TestClassLayer:
+            def test_class_data(self, person, class_person, db_session):
+                assert db_session.query(person).get(2).name == 'class'
+                assert db_session.query(person).count() == 2
+
+        def test_class_data_rolled_back(person, module_person, db_session):
+            assert db_session.query(person).count() == 1
+    """, test_b_after_layers="""
+        import sqlalchemy as sa
+
+        def test_module_data_rolled_back(db_engine):
+            assert not db_engine.execute(sa.text('select * from module_log')).fetchone()
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=5)
+
+
+def test_isolation_strategies(db_testdir):
+    '''
+    Make sure that the truncate and template isolation strategies undo changes
+    committed through connections that the plugin doesn't hand out.
+    '''
+    db_testdir.makepyfile("""
+        import pytest
+
+        def insert_person(_db, person, id):
+            # Bypass the transactional fixtures, the way that a background
+            # thread of the app might
+            with _db.engine.begin() as connection:
+                connection.execute(person.__table__.insert(), {'id': id, 'name': 'tester'})
+
+        @pytest.mark.isolation('truncate')
+        def test_truncate(person, _db, db_session):
+            insert_person(_db, person, 1)
+            assert db_session.query(person).get(1).name == 'tester'
+
+        @pytest.mark.isolation('template')
+        def test_template(person, _db, db_session):
+            insert_person(_db, person, 2)
+            assert db_session.query(person).get(2).name == 'tester'
+
+        def test_changes_dont_persist(person, db_session):
+            assert not db_session.query(person).first()
+
+        @pytest.mark.isolation('nonexistent')
+        def test_unknown_strategy(db_session):
+            pass
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=3, errors=1)
+    result.stdout.fnmatch_lines(["*Unknown isolation strategy 'nonexistent'*"])
+
+
+def test_truncate_dependent_tables(db_testdir):
+    '''
+    Make sure that the truncate isolation strategy also empties the tables that
+    refer to the tables a test wrote to, and nothing else.
+    '''
+    db_testdir.makepyfile("""
+        import pytest
+
+        @pytest.fixture(scope='module')
+        def addresses(_db, person, account_address):
+            account, address = account_address
+
+            # Commit rows for real, outside of any test
+            with _db.engine.begin() as connection:
+                connection.execute(person.__table__.insert(), {'id': 1, 'name': 'tester'})
+                connection.execute(account.__table__.insert(), {'id': 1})
+                connection.execute(address.__table__.insert(), {'id': 1, 'account_id': 1})
+
+            return account, address
+
+        @pytest.mark.isolation('truncate')
+        def test_truncate_account(addresses, _db, db_session):
+            account, _ = addresses
+            with _db.engine.begin() as connection:
+                connection.execute(account.__table__.insert(), {'id': 2})
+
+        def test_dependent_table_emptied(addresses, person, db_session):
+            account, address = addresses
+            assert not db_session.query(account).first()
+            assert not db_session.query(address).first()
+            assert db_session.query(person).get(1).name == 'tester'
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=2)
+
+
+def test_template_keeps_fixture_data(db_testdir):
+    '''
+    Make sure that the template isolation strategy doesn't restore a snapshot
+    taken before fixtures committed their data.
+    '''
+    db_testdir.makepyfile("""
+        import pytest
+
+        @pytest.fixture(scope='module')
+        def tester(_db, person):
+            # Commit a row for real, the way that a module fixture might
+            with _db.engine.begin() as connection:
+                connection.execute(person.__table__.insert(), {'id': 1, 'name': 'tester'})
+
+        @pytest.mark.isolation('template')
+        def test_template_before_fixture(person, db_session):
+            pass
+
+        @pytest.mark.isolation('template')
+        def test_template_after_fixture(tester, person, _db, db_session):
+            with _db.engine.begin() as connection:
+                connection.execute(person.__table__.insert(), {'id': 2, 'name': 'tester'})
+
+        def test_fixture_data_kept(tester, person, db_session):
+            assert db_session.query(person).get(1).name == 'tester'
+            assert not db_session.query(person).get(2)
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=3)
+
+
+def test_template_with_pinned_connection(db_testdir):
+    '''
+    Make sure that the template isolation strategy refuses to copy the database
+    while a connection that outlives the test is open.
+    '''
+    db_testdir.makepyfile("""
+        import pytest
+
+        def test_module_layer(person, db_session_module):
+            pass
+
+        @pytest.mark.isolation('template')
+        def test_template(person, db_session):
+            pass
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=1, errors=1)
+    result.stdout.fnmatch_lines(["*can't copy the database while other connections to it are open*"])
+
+
+def test_xdist_databases(db_testdir):
+    '''
+    Make sure that when the `xdist-databases` option is enabled, each pytest-xdist
+    worker runs its tests against its own database.
+    '''
+    db_testdir.makeini("""
+        [pytest]
+        xdist-databases=true
+    """)
+
+    db_testdir.makepyfile("""
+        import os
+
+        import pytest
+
+        @pytest.fixture(scope='session')
+        def database():
+            # The plugin creates the databases for each worker
+            pass
+
+        @pytest.mark.parametrize('run', range(4))
+        def test_worker_database(person, db_engine, db_session, run):
+            worker = os.environ['PYTEST_XDIST_WORKER']
+            assert db_engine.url.database.endswith('_' + worker)
+
+            db_session.add(person(id=1, name='tester'))
+            db_session.commit()
+
+            assert db_session.query(person).get(1).name == 'tester'
+    """)
+
+    result = db_testdir.runpytest('-n', '2')
+    result.assert_outcomes(passed=4)
+
+
+def test_xdist_databases_module_scoped_db(db_testdir):
+    '''
+    Make sure that the `xdist-databases` option refuses a `_db` fixture that
+    isn't session-scoped, since the worker database has to stay bound to it.
+    '''
+    db_testdir.makeini("""
+        [pytest]
+        xdist-databases=true
+    """)
+
+    db_testdir.makepyfile("""
+        import pytest
+        from flask_sqlalchemy import SQLAlchemy
+
+        @pytest.fixture(scope='module')
+        def _db(app):
+            return SQLAlchemy(app=app)
+
+        def test_worker_database(db_session):
+            pass
+    """)
+
+    result = db_testdir.runpytest('-n', '1')
+    result.assert_outcomes(errors=1)
+    result.stdout.fnmatch_lines(['*xdist-databases option requires the _db fixture to be session-scoped*'])
+
+
+def test_schema_cache(db_testdir):
+    '''
+    Make sure that when the `schema-cache` option is enabled, the schema is only
+    built again when the metadata has changed.
+    '''
+    db_testdir.makeini("""
+        [pytest]
+        schema-cache=true
+    """)
+
+    test_file = """
+        import pytest
+        import sqlalchemy as sa
+
+        from conftest import DB_CONN
+        from pytest_flask_sqlalchemy import databases
+
+        @pytest.fixture(scope='session')
+        def database():
+            # Keep the database between test runs, so that its schema can be reused
+            url = sa.engine.url.make_url(DB_CONN)
+            if not databases.database_exists(url):
+                databases.create_database(url)
+
+        @pytest.fixture(scope='module')
+        def pet(_db, db_create_all):
+            class Pet(_db.Model):
+                __tablename__ = 'pet'
+                id = _db.Column(_db.Integer, primary_key=True)
+                {extra_column}
+
+            print('schema built: {{}}'.format(db_create_all(_db)))
+            return Pet
+
+        def test_schema_cache(pet, db_session):
+            assert not db_session.query(pet).first()
+    """
+
+    try:
+        db_testdir.makepyfile(test_file.format(extra_column=''))
+
+        result = db_testdir.runpytest('-s')
+        result.assert_outcomes(passed=1)
+        result.stdout.fnmatch_lines(['*schema built: True*'])
+
+        # The schema hasn't changed, so it shouldn't be built again
+        result = db_testdir.runpytest('-s')
+        result.assert_outcomes(passed=1)
+        result.stdout.fnmatch_lines(['*schema built: False*'])
+
+        # Changing the metadata should trigger a rebuild
+        db_testdir.makepyfile(test_file.format(extra_column='name = _db.Column(_db.String(80))'))
+
+        result = db_testdir.runpytest('-s')
+        result.assert_outcomes(passed=1)
+        result.stdout.fnmatch_lines(['*schema built: True*'])
+    finally:
+        databases.drop_database(sa.engine.url.make_url(os.environ['TEST_DATABASE_URL']))
+
+
+def test_max_queries(db_testdir):
+    '''
+    Make sure that the `max_queries` marker fails tests that exceed their query
+    budget or repeat the same statement with different parameters.
+    '''
+    db_testdir.makepyfile("""
+        import pytest
+
+        @pytest.fixture
+        def people(person, db_session):
+            for id in range(5):
+                db_session.add(person(id=id, name='tester'))
+            db_session.commit()
+
+        @pytest.mark.max_queries(1)
+        def test_within_budget(people, person, db_session, db_query_counter):
+            assert db_session.query(person).count() == 5
+            assert db_query_counter.count == 1
+
+        @pytest.mark.max_queries(1)
+        def test_over_budget(people, person, db_session):
+            db_session.query(person).count()
+            db_session.query(person).count()
+
+        @pytest.mark.max_queries(10, max_repeats=2)
+        def test_repeated_statement(people, person, db_session):
+            db_session.expire_all()
+            for id in range(5):
+                db_session.query(person).get(id)
+    """)
+
+    result = db_testdir.runpytest()
+    result.assert_outcomes(passed=1, failed=2)
+    result.stdout.fnmatch_lines([
+        '*2 queries were executed, but the limit is 1*',
+        '*Statement executed 5 times with different parameters (limit 2): SELECT*FROM person*',
+    ])
+
+
+def test_sqlite_memory_database(testdir):
+    '''
+    Make sure that the fixtures isolate tests that run against an in-memory
+    SQLite database, without any of the usual pysqlite workarounds in the
+    user's conftest.
+    '''
+    testdir.makeconftest("""
+        import pytest
+        from flask import Flask
+        from flask_sqlalchemy import SQLAlchemy
+
+        @pytest.fixture(scope='session')
+        def _db():
+            app = Flask(__name__)
+            app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+            app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+            # Flask-SQLAlchemy 3 only finds its engines within an app context
+            with app.app_context():
+                yield SQLAlchemy(app=app)
+
+        @pytest.fixture(scope='session')
+        def person(_db):
+            class Person(_db.Model):
+                __tablename__ = 'person'
+                id = _db.Column(_db.Integer, primary_key=True)
+                name = _db.Column(_db.String(80))
+
+            _db.create_all()
+
+            return Person
+    """)
+
+    testdir.makepyfile("""
+        import sqlalchemy as sa
+
+        def test_commit(person, db_session):
+            db_session.add(person(id=1, name='tester'))
+            db_session.commit()
+
+            db_session.add(person(id=2, name='second tester'))
+            db_session.commit()
+
+            assert db_session.query(person).count() == 2
+
+        def test_raw_connection_rollback(person, db_engine):
+            conn = db_engine.raw_connection()
+            cursor = conn.cursor()
+            cursor.execute("insert into person (id, name) values (3, 'raw tester')")
+            conn.rollback()
+            cursor.close()
+
+            assert not db_engine.execute(sa.text('select * from person')).fetchone()
+
+        def test_changes_dont_persist(person, db_session):
+            assert not db_session.query(person).first()
+    """)
+
+    result = testdir.runpytest()
+    result.assert_outcomes(passed=3)
+
+
+def test_multiple_binds(testdir):
+    '''
+    Make sure that models using another bind run in a transaction of their own,
+    which only opens once a test uses it and rolls back with the rest.
+    '''
+    testdir.makeconftest("""
+        import pytest
+        from flask import Flask
+        from flask_sqlalchemy import SQLAlchemy
+
+        @pytest.fixture(scope='session')
+        def _db():
+            app = Flask(__name__)
+            app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+            app.config['SQLALCHEMY_BINDS'] = {'analytics': 'sqlite://'}
+            app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+            # Flask-SQLAlchemy 3 only finds its engines within an app context
+            with app.app_context():
+                yield SQLAlchemy(app=app)
+
+        @pytest.fixture(scope='session')
+        def models(_db):
+            class Person(_db.Model):
+                __tablename__ = 'person'
+                id = _db.Column(_db.Integer, primary_key=True)
+                name = _db.Column(_db.String(80))
+
+            class Event(_db.Model):
+                __tablename__ = 'event'
+                __bind_key__ = 'analytics'
+                id = _db.Column(_db.Integer, primary_key=True)
+                name = _db.Column(_db.String(80))
+
+            _db.create_all()
+
+            return Person, Event
+    """)
+
+    testdir.makepyfile("""
+        import sqlalchemy as sa
+
+        def test_commit_to_both_binds(models, db_session, _transaction):
+            person, event = models
+            db_session.add(person(id=1, name='tester'))
+            db_session.add(event(id=1, name='signup'))
+            db_session.commit()
+
+            analytics = _transaction.binds['analytics'].connection
+            assert db_session.get_bind(event) is analytics
+            assert analytics.execute(sa.text('select count(*) from event')).scalar() == 1
+            assert db_session.query(person).count() == 1
+
+        def test_unused_bind_not_opened(models, db_session, _transaction):
+            person, _ = models
+            assert not db_session.query(person).first()
+            assert not _transaction.binds['analytics'].is_open
+
+        def test_changes_dont_persist(models, db_session):
+            person, event = models
+            assert not db_session.query(person).first()
+            assert not db_session.query(event).first()
+    """)
+
+    result = testdir.runpytest()
+    result.assert_outcomes(passed=3)
+
+
+def test_async_fixtures(testdir):
+    '''
+    Make sure that the async fixtures isolate tests that use an AsyncEngine,
+    and patch the mocked async engines and sessions.
+    '''
+    # The async fixtures need SQLAlchemy 1.4 or newer and the optional async
+    # dependencies, without which the plugin leaves them out
+    pytest.importorskip('sqlalchemy.ext.asyncio')
+    pytest.importorskip('pytest_asyncio')
+    pytest.importorskip('aiosqlite')
+
+    testdir.makeini("""
+        [pytest]
+        mocked-async-engines=database.engine
+        mocked-async-sessions=database.session
+    """)
+
+    testdir.makepyfile(database="""
+        engine = None
+        session = None
+    """)
+
+    testdir.makeconftest("""
+        import pytest
+        import sqlalchemy as sa
+        from sqlalchemy.ext.asyncio import create_async_engine
+        from sqlalchemy.orm import declarative_base
+
+        Base = declarative_base()
+
+        class Person(Base):
+            __tablename__ = 'person'
+            id = sa.Column(sa.Integer, primary_key=True)
+            name = sa.Column(sa.String(80))
+
+        @pytest.fixture(scope='session')
+        def _async_db(tmp_path_factory):
+            path = tmp_path_factory.mktemp('async') / 'test.db'
+
+            engine = sa.create_engine('sqlite:///{}'.format(path))
+            Base.metadata.create_all(engine)
+            engine.dispose()
+
+            return create_async_engine('sqlite+aiosqlite:///{}'.format(path))
+    """)
+
+    testdir.makepyfile("""
+        import pytest
+        import sqlalchemy as sa
+
+        import database
+        from conftest import Person
+
+        @pytest.mark.asyncio
+        async def test_async_db_session(async_db_session):
+            assert database.session is async_db_session
+
+            async_db_session.add(Person(id=1, name='tester'))
+            await async_db_session.commit()
+
+            async_db_session.add(Person(id=2, name='second tester'))
+            await async_db_session.commit()
+
+            await async_db_session.close()
+
+            result = await async_db_session.execute(sa.select(Person))
+            assert len(result.scalars().all()) == 2
+
+        @pytest.mark.asyncio
+        async def test_async_db_engine(async_db_engine):
+            assert database.engine is async_db_engine
+
+            async with async_db_engine.begin() as conn:
+                await conn.execute(sa.text("insert into person (id, name) values (3, 'tester')"))
+
+            async with async_db_engine.connect() as conn:
+                result = await conn.execute(sa.text('select count(*) from person'))
+                assert result.scalar() == 1
+
+        @pytest.mark.asyncio
+        async def test_changes_dont_persist(async_db_engine):
+            async with async_db_engine.connect() as conn:
+                result = await conn.execute(sa.text('select count(*) from person'))
+                assert result.scalar() == 0
+    """)
+
+    result = testdir.runpytest()
+    result.assert_outcomes(passed=3)